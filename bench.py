@@ -0,0 +1,235 @@
+"""Benchmarks for the provisioning pipeline against a local stand-in for EC2
+
+Every scenario runs in its own process against moto's EC2 mock, with a
+fixed latency added to each API call, and reports wall clock time, API call
+counts and peak memory. Needs moto: pip install -r requirements-bench.txt
+
+    python bench.py                          # run every scenario
+    python bench.py --scenario subnets-50    # run one
+    python bench.py --save baseline.json     # keep the results
+    python bench.py --compare baseline.json  # fail on regressions
+"""
+import argparse
+import ipaddress
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import Counter
+from pathlib import Path
+
+PROFILE = 'demo'
+REGION = 'ap-southeast-2'
+DEFAULT_LATENCY = 0.02
+DEFAULT_THRESHOLD = 1.2
+
+
+def scenario_small(cli):
+    """The whole runbook in one apply"""
+    cli.main(['--profile', PROFILE, '--region', REGION, 'apply'])
+
+
+def scenario_handlers(cli, timed):
+    """Each apply step by itself, in dependency order"""
+    session = cli.get_session(PROFILE, REGION)
+    for name, (func, deps) in cli.apply_steps().items():
+        with timed(name):
+            func(session)
+
+
+def scenario_subnets_50(cli):
+    """One VPC carved into 50 subnets"""
+    session = cli.get_session(PROFILE, REGION)
+    cli.vpc_create(session)
+    cidrs = ipaddress.ip_network(cli.DEFAULT_CIDR).subnets(new_prefix=28)
+    cli.subnet_create(session, subnet_cidrs=[str(next(cidrs))
+                                             for _ in range(50)])
+
+
+def scenario_instances_500(cli):
+    """A 500 instance fleet over three /22 subnets"""
+    session = cli.get_session(PROFILE, REGION)
+    cli.vpc_create(session)
+    cli.subnet_create(session, subnet_cidrs=['10.0.0.0/22', '10.0.4.0/22',
+                                             '10.0.8.0/22'])
+    cli.security_group_create(session)
+    cli.main(['--profile', PROFILE, '--region', REGION,
+              'ec2', '--action', 'create', '--count', '500'])
+
+
+SCENARIOS = {
+    'small': scenario_small,
+    'handlers': scenario_handlers,
+    'subnets-50': scenario_subnets_50,
+    'instances-500': scenario_instances_500,
+}
+
+
+def fake_aws_config(directory):
+    """Point boto3 at a profile with dummy credentials"""
+    credentials = Path(directory) / 'credentials'
+    credentials.write_text(f'[{PROFILE}]\n'
+                           'aws_access_key_id = testing\n'
+                           'aws_secret_access_key = testing\n')
+    config = Path(directory) / 'config'
+    config.write_text(f'[profile {PROFILE}]\nregion = {REGION}\n')
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = str(credentials)
+    os.environ['AWS_CONFIG_FILE'] = str(config)
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY',
+                 'AWS_SESSION_TOKEN', 'AWS_PROFILE'):
+        os.environ.pop(name, None)
+
+
+def run_scenario(name, latency):
+    """Run one scenario in this process, return its results"""
+    try:
+        from moto import mock_aws
+    except ImportError:
+        sys.exit('moto is required: pip install -r requirements-bench.txt')
+
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    import cli
+
+    random.seed(0)
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    fake_aws_config(workdir)
+    os.chdir(workdir)
+
+    calls = Counter()
+    results = []
+
+    def count(model, **kwargs):
+        calls[model.name] += 1
+
+    def delay(**kwargs):
+        time.sleep(latency)
+
+    def timed(step):
+        class Timer:
+            def __enter__(self):
+                self.calls = sum(calls.values())
+                self.start = time.perf_counter()
+
+            def __exit__(self, *exc):
+                results.append({
+                    'scenario': f'{name}/{step}',
+                    'seconds': time.perf_counter() - self.start,
+                    'api_calls': sum(calls.values()) - self.calls,
+                })
+        return Timer()
+
+    with mock_aws():
+        session = cli.get_session(PROFILE, REGION)
+        session.events.register('before-call', count)
+        session.events.register('before-send', delay)
+        scenario = SCENARIOS[name]
+        start = time.perf_counter()
+        if scenario is scenario_handlers:
+            scenario(cli, timed)
+        else:
+            scenario(cli)
+        seconds = time.perf_counter() - start
+
+    results.append({
+        'scenario': name,
+        'seconds': seconds,
+        'api_calls': sum(calls.values()),
+        'calls_by_operation': dict(calls.most_common()),
+        # ru_maxrss is in KiB on Linux
+        'peak_memory_mb': resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+    return results
+
+
+def run_isolated(name, latency):
+    """Run a scenario in a fresh process, so state and memory don't leak"""
+    output = subprocess.run(
+        [sys.executable, __file__, '--run', name, '--latency', str(latency)],
+        check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def compare(results, baseline, threshold):
+    """Scenarios slower or making more calls than baseline * threshold"""
+    before = {r['scenario']: r for r in baseline}
+    regressions = []
+    for result in results:
+        old = before.get(result['scenario'])
+        if not old:
+            continue
+        for metric in ('seconds', 'api_calls'):
+            if result[metric] > old[metric] * threshold:
+                regressions.append(
+                    f"{result['scenario']}: {metric} {old[metric]:.2f} -> "
+                    f"{result[metric]:.2f}")
+    return regressions
+
+
+def print_results(results):
+    """"""
+    print(f'{"scenario":<44} {"seconds":>8} {"api calls":>9} '
+          f'{"peak MB":>8}')
+    for r in results:
+        memory = r.get('peak_memory_mb')
+        memory = f'{memory:8.1f}' if memory is not None else f'{"":8}'
+        print(f'{r["scenario"]:<44} {r["seconds"]:8.2f} '
+              f'{r["api_calls"]:9} {memory}')
+
+
+def main():
+    """"""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the provisioning pipeline against mocked EC2')
+    parser.add_argument('--scenario', action='append',
+                        choices=list(SCENARIOS),
+                        help='Scenario to run, all of them by default')
+    parser.add_argument('--latency', action='store', type=float,
+                        default=DEFAULT_LATENCY,
+                        help='Seconds added to every API call, defaults to '
+                             f'{DEFAULT_LATENCY}')
+    parser.add_argument('--save', action='store', metavar='PATH',
+                        help='Write the results to PATH')
+    parser.add_argument('--compare', action='store', metavar='PATH',
+                        help='Fail when a scenario regressed against the '
+                             'results saved in PATH')
+    parser.add_argument('--threshold', action='store', type=float,
+                        default=DEFAULT_THRESHOLD,
+                        help='Allowed ratio to the baseline, defaults to '
+                             f'{DEFAULT_THRESHOLD}')
+    parser.add_argument('--run', action='store', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        results = run_scenario(args.run, args.latency)
+        # cli prints progress, the results are the last line
+        print(json.dumps(results))
+        return
+
+    results = []
+    for name in args.scenario or SCENARIOS:
+        results.extend(run_isolated(name, args.latency))
+    print_results(results)
+
+    if args.save:
+        with open(args.save, 'w') as fo:
+            json.dump(results, fo, indent=2)
+        print(f'Written: {args.save}')
+
+    if args.compare:
+        with open(args.compare, 'r') as fo:
+            baseline = json.load(fo)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,1542 @@
+# Taken before the other imports so --startup_timing includes them
+import time; _IMPORTS_STARTED = time.perf_counter()  # noqa: E702
 import argparse
+import bisect
+import contextlib
+import contextvars
+import fcntl
+import hashlib
+import io
+import ipaddress
 import json
-
+import os
+import random
+import re
+import select
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 
-import boto3
-import boto3.session
-import botocore
+# boto3 and botocore are imported on first use, so --help, argument errors
+# and other paths that never talk to AWS don't pay for loading them.
 
 DEFAULT_CIDR = '10.0.0.0/16'
+DEFAULT_SUBNET_PREFIX = 28
+# Subnet sizes EC2 allows
+SUBNET_PREFIX_RANGE = range(16, 29)
+DEFAULT_SUBNETS_PER_AZ = 1
 DEFAULT_NAME = 'demo'
+DEFAULT_REGION = 'ap-southeast-2'
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+DEFAULT_CACHE_TTL = 60
+DEFAULT_CACHE_SIZE = 256
+DEFAULT_CHUNK_SIZE = 100
+DEFAULT_RULE_BATCH = 100
+DEFAULT_SOCKET = Path('outputs') / 'cli.sock'
+DEFAULT_WATCH_INTERVAL = 30
+DEFAULT_WATCH_MAX_INTERVAL = 300
+DEFAULT_AMI_NAME = 'al2023-ami-2023.*-x86_64'
+DEFAULT_AMI_OWNER = 'amazon'
+DEFAULT_METADATA_TTLS = {'az': 86400, 'ami': 21600}
+DEFAULT_MAX_ATTEMPTS = 10
+WAIT_INITIAL_DELAY = 1.0
+WAIT_MAX_DELAY = 15.0
+WAIT_TIMEOUT = 600
 services = ['vpc']
 
+# Sessions, clients and resources shared by every command in the process.
+# Clients are thread safe and keep their HTTP connection pools for reuse,
+# resources are not, so those are kept per thread.
+_registry_lock = threading.Lock()
+_sessions = {}
+_clients = {}
+_resources = threading.local()
+_client_config = {'max_pool_connections': DEFAULT_MAX_POOL_CONNECTIONS,
+                  'retries': {'mode': 'adaptive',
+                              'max_attempts': DEFAULT_MAX_ATTEMPTS}}
+
+# Outputs and state of the region being worked on, see run_regions()
+_output_dir = contextvars.ContextVar('output_dir',
+                                     default=Path('outputs') / DEFAULT_REGION)
+
+# Reported with --startup_timing, in seconds
+_startup_timing = {}
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor running tasks in a copy of the submitter's context
+
+    Keeps the per region output directory when work moves to other threads.
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        context = contextvars.copy_context()
+        return super().submit(context.run, fn, *args, **kwargs)
+
+
+def output_dir():
+    """Directory for outputs and state of the current region"""
+    return _output_dir.get()
+
 
 def write_output_json(filename, data):
     """Write JSON output to disk"""
-    path = Path('outputs') / filename
+    path = output_dir() / filename
+    path.parent.mkdir(parents=True, exist_ok=True)
     with open(path, 'w') as fo:
         json.dump(data, fo, indent=2)
     print(f'Written: {path}')
 
 
-def read_output_json(filename):
-    """"""
-    path = Path('outputs') / filename
+def _import_boto3():
+    """Import boto3 and botocore, recording how long it took"""
+    if 'boto3.session' not in sys.modules:
+        start = time.perf_counter()
+        import boto3.session  # noqa: F401
+        import botocore.config  # noqa: F401
+        import botocore.exceptions  # noqa: F401
+        _startup_timing['boto3 import'] = time.perf_counter() - start
+    return sys.modules['boto3']
+
+
+def print_startup_timing(title='Startup timing'):
+    """Print where startup time went to stderr"""
+    print(f'{title}:', file=sys.stderr)
+    for name, seconds in _startup_timing.items():
+        print(f'  {name:<14} {seconds * 1000:8.1f} ms', file=sys.stderr)
+
+
+def configure_clients(max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS,
+                      max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Set the connection pool and retries for clients created from now on
+
+    Adaptive retries back off on throttling errors with client side rate
+    limiting on top of the standard retry policy.
+    """
+    with _registry_lock:
+        _client_config['max_pool_connections'] = max_pool_connections
+        _client_config['retries'] = {'mode': 'adaptive',
+                                     'max_attempts': max_attempts}
+
+
+def get_session(profile=None, region=None):
+    """Shared session for profile and region"""
+    key = (profile, region)
+    boto3 = _import_boto3()
+    with _registry_lock:
+        if key not in _sessions:
+            _sessions[key] = boto3.session.Session(profile_name=profile,
+                                                   region_name=region)
+        return _sessions[key]
+
+
+def _registry_key(session, service):
+    return (session.profile_name, session.region_name, service)
+
+
+def get_client(session, service='ec2'):
+    """Shared client for the session's (profile, region, service)"""
+    key = _registry_key(session, service)
+    with _registry_lock:
+        if key not in _clients:
+            from botocore.config import Config
+            config = Config(**_client_config)
+            client = session.client(service, config=config)
+            _register_hooks(client.meta.events)
+            _clients[key] = client
+        return _clients[key]
+
+
+def _register_hooks(events):
+    """Hook the CLI's botocore event handlers into a client"""
+    # Replaying a journaled call skips the before-call hooks after it
+    events.register('before-parameter-build', _journal_params)
+    events.register('before-call', _journal_before_call)
+    events.register('after-call', _journal_after_call)
+    events.register('after-call', _invalidate_describe_cache)
+    events.register('before-parameter-build', _remember_params)
+    events.register('after-call', _update_tag_indexes)
+    if _rate_limiter is not None:
+        _rate_limiter.register(events)
+    if _tracer is not None:
+        _tracer.register(events)
+
+
+def get_resource(session, service='ec2'):
+    """Resource for the session's (profile, region, service), per thread"""
+    key = _registry_key(session, service)
+    resources = getattr(_resources, 'registry', None)
+    if resources is None:
+        resources = _resources.registry = {}
+    if key not in resources:
+        with _registry_lock:
+            from botocore.config import Config
+            config = Config(**_client_config)
+            resource = session.resource(service, config=config)
+            _register_hooks(resource.meta.client.meta.events)
+            resources[key] = resource
+    return resources[key]
+
+
+def file_lock(path, mode=fcntl.LOCK_EX):
+    """Open path + '.lock' and flock it, close the file to unlock"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fo = open(path.with_name(path.name + '.lock'), 'a')
+    fcntl.flock(fo, mode)
+    return fo
+
+
+def read_json(path, default=None):
+    """JSON from path, or default when the file doesn't exist"""
+    path = Path(path)
+    if not path.exists():
+        return default
     with open(path, 'r') as fo:
-        data = json.load(fo)
-    return data
+        return json.load(fo)
+
+
+def file_version(path):
+    """(inode, mtime, size) of path, or None when it doesn't exist
+
+    Changes with every write_json_atomic(), which replaces the file.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def write_json_atomic(path, data):
+    """Write JSON to a temporary file and move it over path"""
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name)
+    try:
+        with os.fdopen(fd, 'w') as fo:
+            json.dump(data, fo, indent=2, default=str)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class StateStore:
+    """Resource ids by resource type and Name tag, kept in one state file
+
+    Lookups are served from memory, the file is only read again once it
+    changed on disk. Writes take an exclusive lock on a sidecar lock file,
+    merge the change into the latest copy on disk and replace the file
+    atomically, so CLI processes running at the same time don't lose each
+    other's updates.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._data = None
+        self._version = None
+
+    def _load(self):
+        if self._data is None or file_version(self.path) != self._version:
+            with file_lock(self.path, fcntl.LOCK_SH):
+                self._version = file_version(self.path)
+                self._data = read_json(self.path, {})
+        return self._data
+
+    def _update(self, change):
+        with self._lock, file_lock(self.path):
+            data = read_json(self.path, {})
+            change(data)
+            write_json_atomic(self.path, data)
+            self._data = data
+            self._version = file_version(self.path)
+
+    def get(self, resource_type, name=DEFAULT_NAME):
+        """{'id': ..., 'data': ...} for the resource, or None"""
+        with self._lock:
+            return self._load().get(resource_type, {}).get(name)
+
+    def get_id(self, resource_type, name=DEFAULT_NAME):
+        """Id of the resource, or None"""
+        entry = self.get(resource_type, name)
+        return entry.get('id') if entry else None
+
+    def ids(self, resource_type, prefix=''):
+        """Ids of all resources of a type whose name starts with prefix"""
+        with self._lock:
+            entries = self._load().get(resource_type, {})
+            return [entry['id'] for name, entry in sorted(entries.items())
+                    if name.startswith(prefix)]
+
+    def named_ids(self, resource_type, prefix=''):
+        """{name: id} of a type's resources whose name starts with prefix"""
+        with self._lock:
+            entries = self._load().get(resource_type, {})
+            return {name: entry['id'] for name, entry in entries.items()
+                    if name.startswith(prefix)}
+
+    def reload(self):
+        """Read the state file again on the next lookup"""
+        with self._lock:
+            self._data = None
+
+    def put(self, resource_type, name, resource_id, data=None):
+        """Record a resource"""
+        self.put_many([(resource_type, name, resource_id, data)])
+
+    def put_many(self, resources):
+        """Record [(resource_type, name, resource_id, data)] in one write"""
+        def change(state):
+            for resource_type, name, resource_id, data in resources:
+                state.setdefault(resource_type, {})[name] = {
+                    'id': resource_id,
+                    'data': data,
+                }
+        if resources:
+            self._update(change)
+
+    def remove(self, resource_type, name):
+        """Forget a resource"""
+        def change(state):
+            state.get(resource_type, {}).pop(name, None)
+        self._update(change)
+
+    def remove_ids(self, resource_ids):
+        """Forget every resource with one of the ids"""
+        resource_ids = set(resource_ids)
+
+        def change(state):
+            for entries in state.values():
+                for name in [name for name, entry in entries.items()
+                             if entry.get('id') in resource_ids]:
+                    del entries[name]
+        if resource_ids:
+            self._update(change)
+
+
+class DescribeCache:
+    """LRU cache of describe_* responses with per resource type TTLs
+
+    Entries are keyed by profile, region, operation and parameters. When a
+    path is given the cache is shared with other processes through that
+    file. Invalidating a resource type records the time, and entries of that
+    type stored earlier are ignored from then on, in every process. The
+    file is read again when another process changed it.
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_CACHE_TTL, ttls=None,
+                 max_entries=DEFAULT_CACHE_SIZE):
+        self.path = Path(path) if path else None
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._invalidated = {}
+        self._version = None
+
+    @staticmethod
+    def key(session, operation, params):
+        return json.dumps([session.profile_name, session.region_name,
+                           operation, params], sort_keys=True, default=str)
+
+    def _load(self):
+        if not self.path or file_version(self.path) == self._version:
+            return
+        with file_lock(self.path, fcntl.LOCK_SH):
+            self._version = file_version(self.path)
+            data = read_json(self.path, {})
+        for resource_type, when in data.get('invalidated', {}).items():
+            self._invalidated[resource_type] = max(
+                when, self._invalidated.get(resource_type, 0))
+        for key, entry in data.get('entries', []):
+            self._entries[key] = entry
+        self._evict()
+
+    def _save(self):
+        if not self.path:
+            return
+        with file_lock(self.path):
+            data = read_json(self.path, {})
+            invalidated = data.get('invalidated', {})
+            for resource_type, when in self._invalidated.items():
+                invalidated[resource_type] = max(
+                    when, invalidated.get(resource_type, 0))
+            entries = OrderedDict(data.get('entries', []))
+            entries.update(self._entries)
+            self._invalidated = invalidated
+            self._entries = entries
+            self._evict()
+            write_json_atomic(self.path, {
+                'invalidated': self._invalidated,
+                'entries': list(self._entries.items()),
+            })
+            self._version = file_version(self.path)
+
+    def _valid(self, entry, now):
+        stored = entry['stored']
+        ttl = self.ttls.get(entry['type'], self.ttl)
+        return (stored + ttl > now
+                and stored > self._invalidated.get(entry['type'], 0))
+
+    def _evict(self):
+        now = time.time()
+        for key in [k for k, e in self._entries.items()
+                    if not self._valid(e, now)]:
+            del self._entries[key]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        """Cached response, or None"""
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+            if entry is None or not self._valid(entry, time.time()):
+                return None
+            self._entries.move_to_end(key)
+            return entry['response']
+
+    def put(self, key, resource_type, response):
+        """Cache a response of a resource type"""
+        with self._lock:
+            self._load()
+            self._entries[key] = {
+                'type': resource_type,
+                'stored': time.time(),
+                'response': response,
+            }
+            self._entries.move_to_end(key)
+            self._evict()
+            self._save()
+
+    def invalidate(self, resource_type):
+        """Drop every cached response of a resource type"""
+        with self._lock:
+            self._load()
+            self._invalidated[resource_type] = time.time()
+            self._evict()
+            self._save()
+
+
+class MetadataCache:
+    """Persistent cache of slow changing lookups such as AZs and AMIs
+
+    Each kind of lookup has its own TTL. Entries older than REFRESH of
+    their TTL are still served, and refreshed by a background thread so
+    the next lookup gets a new value without waiting for it. Only expired
+    or missing entries are looked up while the caller waits.
+    """
+
+    REFRESH = 0.75
+
+    def __init__(self, path, ttls=None):
+        self.path = Path(path)
+        self.ttls = dict(DEFAULT_METADATA_TTLS, **(ttls or {}))
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+    def _store(self, key, value):
+        with file_lock(self.path):
+            entries = read_json(self.path, {})
+            entries[key] = {'stored': time.time(), 'value': value}
+            write_json_atomic(self.path, entries)
+
+    def _refresh(self, key, fetch):
+        try:
+            self._store(key, fetch())
+        except Exception as e:
+            print(f'WARNING: Refreshing {key} failed: {e}', file=sys.stderr)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def get(self, kind, key, fetch):
+        """Value cached for key, from fetch() when missing or expired"""
+        key = json.dumps([kind] + list(key))
+        with file_lock(self.path, fcntl.LOCK_SH):
+            entry = read_json(self.path, {}).get(key)
+        ttl = self.ttls[kind]
+        age = time.time() - entry['stored'] if entry else ttl
+        if age >= ttl:
+            value = fetch()
+            self._store(key, value)
+            return value
+        if age >= ttl * self.REFRESH:
+            with self._lock:
+                start = key not in self._refreshing
+                self._refreshing.add(key)
+            if start:
+                refresh = ContextThreadPoolExecutor(max_workers=1)
+                refresh.submit(self._refresh, key, fetch)
+                refresh.shutdown(wait=False)
+        return entry['value']
+
+
+def parse_metadata_ttl(value):
+    """--metadata_ttl value as (kind, seconds)"""
+    kind, _, seconds = value.partition('=')
+    if kind not in DEFAULT_METADATA_TTLS:
+        raise argparse.ArgumentTypeError(
+            f'unknown kind {kind!r}, expected one of '
+            f'{", ".join(DEFAULT_METADATA_TTLS)}')
+    try:
+        seconds = float(seconds)
+        if seconds < 0:
+            raise ValueError(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f'expected KIND=SECONDS, got {value!r}') from None
+    return kind, seconds
+
+
+# Options of the metadata caches, and the caches by their resolved path so
+# the serve daemon keeps one per working directory
+_metadata_cache_options = {'path': Path('outputs') / 'metadata_cache.json',
+                           'ttls': None}
+_metadata_caches = {}
+
+
+def configure_metadata_cache(ttls=None,
+                             path=Path('outputs') / 'metadata_cache.json'):
+    """Set the TTLs of AZ and AMI lookups, in seconds by kind"""
+    with _registry_lock:
+        _metadata_cache_options.update(path=path, ttls=ttls)
+        _metadata_caches.clear()
+    return metadata_cache()
+
+
+def metadata_cache():
+    """The metadata cache of the working directory"""
+    path = Path(_metadata_cache_options['path']).resolve()
+    with _registry_lock:
+        if path not in _metadata_caches:
+            _metadata_caches[path] = MetadataCache(
+                path, _metadata_cache_options['ttls'])
+        return _metadata_caches[path]
+
+
+# Resource type changed by a mutating EC2 call, first match in the operation
+# name wins
+_MUTATED_TYPES = [
+    ('SecurityGroup', 'security-group'),
+    ('RouteTable', 'route-table'),
+    ('Route', 'route-table'),
+    ('InternetGateway', 'internet-gateway'),
+    ('Subnet', 'subnet'),
+    ('Vpc', 'vpc'),
+    ('Instance', 'instance'),
+]
+
+# Resource type of the ids CreateTags and DeleteTags take, by id prefix
+_TAGGED_TYPES = [
+    ('vpc-', 'vpc'),
+    ('subnet-', 'subnet'),
+    ('igw-', 'internet-gateway'),
+    ('rtb-', 'route-table'),
+    ('sg-', 'security-group'),
+    ('i-', 'instance'),
+]
+
+# Options of the describe caches, None while caching is off, and the caches
+# by their resolved path
+_describe_cache_options = None
+_describe_caches = {}
+
+
+def configure_describe_cache(ttl=DEFAULT_CACHE_TTL, ttls=None,
+                             max_entries=DEFAULT_CACHE_SIZE,
+                             path=Path('outputs') / 'describe_cache.json'):
+    """Turn on caching of describe calls made through describe()"""
+    global _describe_cache_options
+    with _registry_lock:
+        _describe_cache_options = dict(path=path, ttl=ttl, ttls=ttls,
+                                       max_entries=max_entries)
+        _describe_caches.clear()
+
+
+def describe_cache():
+    """The describe cache of the working directory, or None when off"""
+    options = _describe_cache_options
+    if options is None:
+        return None
+    path = Path(options['path']).resolve()
+    with _registry_lock:
+        if path not in _describe_caches:
+            _describe_caches[path] = DescribeCache(
+                path, ttl=options['ttl'], ttls=options['ttls'],
+                max_entries=options['max_entries'])
+        return _describe_caches[path]
+
+
+def parse_cache_ttl(value):
+    """--cache_ttl value as (resource type or None for all, seconds)"""
+    resource_type, _, seconds = value.rpartition('=')
+    types = sorted({t for _, t in _MUTATED_TYPES})
+    if resource_type and resource_type not in types:
+        raise argparse.ArgumentTypeError(
+            f'unknown resource type {resource_type!r}, expected one of '
+            f'{", ".join(types)}')
+    try:
+        seconds = float(seconds)
+        if seconds < 0:
+            raise ValueError(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f'expected [TYPE=]SECONDS, got {value!r}') from None
+    return resource_type or None, seconds
+
+
+def _invalidate_describe_cache(model, context, **kwargs):
+    """botocore after-call hook, invalidates what a mutating call touched
+
+    Tag changes invalidate the types of the resources they tag.
+    """
+    cache = describe_cache()
+    if cache is None or model.name.startswith('Describe'):
+        return
+    if model.name in ('CreateTags', 'DeleteTags'):
+        resources = (context.get('params') or {}).get('Resources', [])
+        for resource_type in {t for r in resources for p, t in _TAGGED_TYPES
+                              if r.startswith(p)}:
+            cache.invalidate(resource_type)
+        return
+    for fragment, resource_type in _MUTATED_TYPES:
+        if fragment in model.name:
+            cache.invalidate(resource_type)
+            return
+
+
+def paginate(session, operation, result_key, **params):
+    """Yield the items under result_key from every page of an operation
+
+    Instances are yielded one by one rather than per reservation.
+    """
+    client = get_client(session)
+    if client.can_paginate(operation):
+        pages = client.get_paginator(operation).paginate(**params)
+    else:
+        pages = [getattr(client, operation)(**params)]
+    for page in pages:
+        for item in page.get(result_key, []):
+            if result_key == 'Reservations':
+                yield from item.get('Instances', [])
+            else:
+                yield item
+
+
+def describe(session, operation, resource_type, result_key, **params):
+    """Yield the items of a describe_* operation as pages arrive
+
+    With the describe cache enabled the items are collected, cached and
+    served from the cache until they expire.
+    """
+    cache = describe_cache()
+    if cache is None:
+        yield from paginate(session, operation, result_key, **params)
+        return
+
+    key = cache.key(session, operation, params)
+    items = cache.get(key)
+    if items is None:
+        items = list(paginate(session, operation, result_key, **params))
+        cache.put(key, resource_type, items)
+    yield from items
+
+
+# Resource types in the tag index, with the prefix of their ids
+_INDEXED_TYPES = {
+    'vpc': 'vpc-',
+    'subnet': 'subnet-',
+    'internet-gateway': 'igw-',
+    'route-table': 'rtb-',
+    'security-group': 'sg-',
+}
+
+# Indexed resource type each delete call removes
+_DELETED_TYPES = {
+    'DeleteVpc': 'vpc',
+    'DeleteSubnet': 'subnet',
+    'DeleteInternetGateway': 'internet-gateway',
+    'DeleteRouteTable': 'route-table',
+    'DeleteSecurityGroup': 'security-group',
+}
+
+_tag_indexes = {}
+
+
+class TagIndex:
+    """Ids of a stack's resources by resource type and Name tag
+
+    Built from one paginated describe_tags sweep over the Names starting
+    with the stack's prefix, then kept up to date from the create, tag and
+    delete calls the CLI makes, see _update_tag_indexes().
+    """
+
+    def __init__(self, session, prefix=DEFAULT_NAME):
+        self.region = session.region_name
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._ids = {}
+        self.refresh(session)
+
+    def refresh(self, session):
+        """Rebuild the index from EC2"""
+        tags = paginate(session, 'describe_tags', 'Tags', Filters=[
+            {'Name': 'key', 'Values': ['Name']},
+            {'Name': 'value', 'Values': [f'{self.prefix}*']},
+            {'Name': 'resource-type', 'Values': list(_INDEXED_TYPES)},
+        ])
+        ids = {}
+        for tag in tags:
+            ids.setdefault((tag['ResourceType'], tag['Value']),
+                           []).append(tag['ResourceId'])
+        with self._lock:
+            self._ids = ids
+
+    def _discard(self, resource_id):
+        for key, ids in list(self._ids.items()):
+            if resource_id in ids:
+                ids.remove(resource_id)
+                if not ids:
+                    del self._ids[key]
+
+    def add(self, resource_type, name, resource_id):
+        """Record a resource, or its new Name"""
+        if not name.startswith(self.prefix):
+            return
+        with self._lock:
+            self._discard(resource_id)
+            self._ids.setdefault((resource_type, name), []).append(
+                resource_id)
+
+    def remove_id(self, resource_id):
+        """Forget a deleted resource"""
+        with self._lock:
+            self._discard(resource_id)
+
+    def ids(self, resource_type, name):
+        """Ids of the resources of a type with the Name"""
+        with self._lock:
+            return list(self._ids.get((resource_type, name), []))
+
+    def get_id(self, resource_type, name):
+        """Id of the resource, or None"""
+        return next(iter(self.ids(resource_type, name)), None)
+
+    def names(self, resource_type):
+        """Names of the indexed resources of a type"""
+        with self._lock:
+            return sorted(name for rtype, name in self._ids
+                          if rtype == resource_type)
+
+
+def tag_index(session, prefix=DEFAULT_NAME):
+    """The process wide tag index of a region and name prefix"""
+    key = (session.profile_name, session.region_name, prefix)
+    with _registry_lock:
+        index = _tag_indexes.get(key)
+    if index is None:
+        index = TagIndex(session, prefix)
+        with _registry_lock:
+            index = _tag_indexes.setdefault(key, index)
+    return index
+
+
+def resource_id(session, resource_type, name, prefix=None):
+    """Id of the named resource, or None when it doesn't exist
+
+    Answered from the tag index. The id in state is preferred while the
+    index has it; one the index doesn't have after a refresh belongs to a
+    resource deleted outside the CLI and is dropped from state.
+    """
+    index = tag_index(session, prefix or name)
+    state = get_state()
+    state_id = state.get_id(resource_type, name)
+    if state_id and state_id not in index.ids(resource_type, name):
+        # Changed by another process since the index was built
+        index.refresh(session)
+        if state_id not in index.ids(resource_type, name):
+            state.remove(resource_type, name)
+            state_id = None
+    return state_id or index.get_id(resource_type, name)
+
+
+def _remember_params(params, context, **kwargs):
+    """botocore before-parameter-build hook, keeps the call's parameters"""
+    context['params'] = params
+
+
+def _update_tag_indexes(model, context, parsed=None, **kwargs):
+    """botocore after-call hook, applies creates and deletes to tag indexes"""
+    parsed = parsed or {}
+    params = context.get('params') or {}
+    with _registry_lock:
+        indexes = [index for index in _tag_indexes.values()
+                   if index.region == context.get('client_region')]
+    if not indexes or 'Error' in parsed:
+        return
+
+    def names(tags):
+        return [t['Value'] for t in tags if t['Key'] == 'Name']
+
+    if model.name == 'CreateTags':
+        for resource in params.get('Resources', []):
+            resource_type = next((t for t, p in _INDEXED_TYPES.items()
+                                  if resource.startswith(p)), None)
+            for name in names(params.get('Tags', [])) if resource_type else []:
+                for index in indexes:
+                    index.add(resource_type, name, resource)
+    elif model.name.startswith('Create'):
+        for spec in params.get('TagSpecifications', []):
+            resource_type = spec.get('ResourceType')
+            if resource_type not in _INDEXED_TYPES:
+                continue
+            id_field = _ID_FIELDS[resource_type]
+            created = [parsed] + [v for v in parsed.values()
+                                  if isinstance(v, dict)]
+            new_id = next((r[id_field] for r in created if id_field in r),
+                          None)
+            for name in names(spec.get('Tags', [])) if new_id else []:
+                for index in indexes:
+                    index.add(resource_type, name, new_id)
+    elif model.name in _DELETED_TYPES:
+        deleted = params.get(_ID_FIELDS[_DELETED_TYPES[model.name]])
+        if isinstance(deleted, str):
+            for index in indexes:
+                index.remove_id(deleted)
+
+
+# The apply run being journaled in this context, and its current step
+_journal_run = contextvars.ContextVar('journal_run', default=None)
+_journal_step = contextvars.ContextVar('journal_step', default=None)
+
+_journals = {}
+
+
+class Journal:
+    """Write-ahead log of the mutations made by apply, read by resume
+
+    One JSON object per line in outputs/<region>/journal.jsonl. A run
+    starts with its plan, every mutating API call is logged before it is
+    sent and again with its resource ids and response once it succeeded,
+    and every finished step is logged.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def append(self, event, **fields):
+        line = json.dumps(dict(event=event, time=time.time(), **fields),
+                          default=str)
+        with self._lock, file_lock(self.path):
+            with open(self.path, 'a') as fo:
+                fo.write(line + '\n')
+                fo.flush()
+                os.fsync(fo.fileno())
+
+    def events(self):
+        """Every event, skipping a last line cut short by a crash"""
+        if not self.path.exists():
+            return []
+        events = []
+        with open(self.path, 'r') as fo:
+            for line in fo:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+        return events
+
+    def start(self, name, plan):
+        """Log the start of an apply of plan, return its JournalRun"""
+        run_id = f'{name}-{time.strftime("%Y%m%dT%H%M%S")}-{os.getpid()}'
+        self.append('run', run=run_id, name=name, plan=plan)
+        return JournalRun(self, run_id, name, plan)
+
+    def last_run(self, name):
+        """JournalRun of the stack's last apply, or None"""
+        events = self.events()
+        run = next((e for e in reversed(events)
+                    if e['event'] == 'run' and e.get('name') == name), None)
+        if run is None:
+            return None
+        return JournalRun(self, run['run'], name, run['plan'],
+                          [e for e in events if e.get('run') == run['run']])
+
+
+class JournalRun:
+    """An apply run written to a journal, with what it already did"""
+
+    def __init__(self, journal, run_id, name, plan, events=()):
+        self.journal = journal
+        self.id = run_id
+        self.name = name
+        self.plan = plan
+        self.responses = {e['key']: e['response'] for e in events
+                          if e['event'] == 'done'}
+        self.steps_done = {e['step'] for e in events if e['event'] == 'step'}
+        self.finished = any(e['event'] == 'finished' for e in events)
+        self._lock = threading.Lock()
+        self._seen = {}
+
+    def log(self, event, **fields):
+        self.journal.append(event, run=self.id, **fields)
+
+    def key(self, operation, params):
+        """Idempotency key of a call, the same when a resume repeats it
+
+        Identical calls in a run are told apart by how many came before.
+        """
+        call = json.dumps([self.id, operation, params], sort_keys=True,
+                          default=str)
+        with self._lock:
+            count = self._seen.get(call, 0)
+            self._seen[call] = count + 1
+        # 64 characters, the longest ClientToken EC2 takes
+        return hashlib.sha256(f'{call}#{count}'.encode()).hexdigest()
+
+
+def get_journal():
+    """The journal of the current region and working directory"""
+    path = (output_dir() / 'journal.jsonl').resolve()
+    with _registry_lock:
+        if path not in _journals:
+            _journals[path] = Journal(path)
+        return _journals[path]
+
+
+def _response_ids(data):
+    """Resource ids in an API response"""
+    ids = []
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if (key.endswith('Id') and isinstance(value, str)
+                    and re.fullmatch(r'[a-z]+-[0-9a-f]+', value)):
+                ids.append(value)
+            elif key != 'ResponseMetadata':
+                ids.extend(_response_ids(value))
+    elif isinstance(data, list):
+        for item in data:
+            ids.extend(_response_ids(item))
+    return list(dict.fromkeys(ids))
+
+
+def _journal_params(model, params, context, **kwargs):
+    """botocore before-parameter-build hook, keys journaled mutations
+
+    Operations taking an idempotency token get the key as their token, in
+    place of the random one botocore generates, so a call repeated by a
+    resume can't create a second resource.
+    """
+    run = _journal_run.get()
+    if run is None or api_category(model.name) != 'mutate':
+        return
+    members = model.input_shape.members if model.input_shape else {}
+    tokens = [name for name, shape in members.items()
+              if shape.metadata.get('idempotencyToken')]
+    key = run.key(model.name, {k: v for k, v in params.items()
+                               if k not in tokens})
+    for name in tokens:
+        params[name] = key
+    context['journal'] = key
+
+
+def _journal_before_call(model, context, **kwargs):
+    """botocore before-call hook, logs a mutation or replays a logged one"""
+    run = _journal_run.get()
+    key = context.get('journal')
+    if run is None or key is None:
+        return None
+    if key in run.responses:
+        from botocore.awsrequest import AWSResponse
+        context['journal_replayed'] = True
+        return AWSResponse(None, 200, {}, None), run.responses[key]
+    run.log('call', step=_journal_step.get(), operation=model.name, key=key)
+    return None
+
+
+def _journal_after_call(model, context, parsed=None, **kwargs):
+    """botocore after-call hook, logs a mutation that succeeded"""
+    run = _journal_run.get()
+    key = context.get('journal')
+    if (run is None or key is None or context.get('journal_replayed')
+            or 'Error' in (parsed or {})):
+        return
+    response = {k: v for k, v in (parsed or {}).items()
+                if k != 'ResponseMetadata'}
+    run.log('done', step=_journal_step.get(), operation=model.name, key=key,
+            ids=_response_ids(response), response=response)
+
+
+# Error codes EC2 and other services use when throttling requests
+THROTTLE_CODES = {
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+}
+
+
+class Tracer:
+    """Records API calls, waits and steps of a run for --trace
+
+    Hooks into botocore's events on every client the CLI creates. Each API
+    call records its start and end, the latency of each HTTP attempt, the
+    number of retries and throttling errors. Waits and steps are recorded
+    as spans around them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._threads = {}
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def register(self, events):
+        events.register('before-call', self._before_call)
+        events.register('before-send', self._before_send)
+        events.register('response-received', self._response_received)
+        events.register('after-call', self._after_call)
+        events.register('after-call-error', self._after_call_error)
+
+    def _tid(self):
+        with self._lock:
+            return self._threads.setdefault(threading.get_ident(),
+                                            len(self._threads) + 1)
+
+    def _record(self, name, category, start, end, **args):
+        span = {'name': name, 'cat': category, 'start': start, 'end': end,
+                'tid': self._tid(), 'args': args}
+        with self._lock:
+            self.spans.append(span)
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        """Record the time spent in a with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, category, start, time.perf_counter(), **args)
+
+    def _before_call(self, model, context, **kwargs):
+        context['trace'] = {'operation': model.name, 'http': [],
+                            'throttles': 0, 'start': time.perf_counter()}
+
+    def _before_send(self, request, **kwargs):
+        trace = request.context.get('trace')
+        if trace is not None:
+            trace['sent'] = time.perf_counter()
+
+    def _response_received(self, context, parsed_response=None, **kwargs):
+        trace = context.get('trace')
+        if trace is None or 'sent' not in trace:
+            return
+        trace['http'].append(time.perf_counter() - trace.pop('sent'))
+        code = (parsed_response or {}).get('Error', {}).get('Code')
+        if code in THROTTLE_CODES:
+            trace['throttles'] += 1
+
+    def _finish(self, context, error=None):
+        trace = context.get('trace')
+        if trace is None:
+            return
+        self._record(trace['operation'], 'api', trace['start'],
+                     time.perf_counter(),
+                     region=context.get('client_region'),
+                     http_latency=trace['http'],
+                     retries=max(len(trace['http']) - 1, 0),
+                     throttles=trace['throttles'], error=error)
+
+    def _after_call(self, context, parsed=None, **kwargs):
+        error = (parsed or {}).get('Error', {}).get('Code')
+        self._finish(context, error=error)
+
+    def _after_call_error(self, context, exception=None, **kwargs):
+        self._finish(context, error=repr(exception))
+
+    def write(self, path):
+        """Write the spans as a Chrome trace (chrome://tracing, Perfetto)"""
+        events = []
+        for span in self.spans:
+            events.append({
+                'name': span['name'],
+                'cat': span['cat'],
+                'ph': 'X',
+                'pid': 1,
+                'tid': span['tid'],
+                'ts': (span['start'] - self.started) * 1e6,
+                'dur': (span['end'] - span['start']) * 1e6,
+                'args': span['args'],
+            })
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as fo:
+            json.dump({'traceEvents': events}, fo, default=str)
+        print(f'Written: {path}', file=sys.stderr)
+
+    def summary(self, top=15):
+        """Print the operations and waits that took longest in total"""
+        totals = {}
+        for span in self.spans:
+            if span['cat'] not in ('api', 'wait'):
+                continue
+            total = totals.setdefault(
+                (span['cat'], span['name']),
+                {'calls': 0, 'seconds': 0.0, 'max': 0.0, 'http': 0.0,
+                 'retries': 0, 'throttles': 0, 'errors': 0})
+            seconds = span['end'] - span['start']
+            total['calls'] += 1
+            total['seconds'] += seconds
+            total['max'] = max(total['max'], seconds)
+            total['http'] += sum(span['args'].get('http_latency', []))
+            total['retries'] += span['args'].get('retries', 0)
+            total['throttles'] += span['args'].get('throttles', 0)
+            total['errors'] += 1 if span['args'].get('error') else 0
+
+        print(f'{"operation":<36} {"calls":>5} {"total s":>8} {"max s":>7} '
+              f'{"http s":>7} {"retries":>7} {"throttled":>9} {"errors":>6}',
+              file=sys.stderr)
+        ranked = sorted(totals.items(), key=lambda kv: -kv[1]['seconds'])
+        for (category, name), t in ranked[:top]:
+            label = name if category == 'api' else f'[{category}] {name}'
+            print(f'{label:<36} {t["calls"]:>5} {t["seconds"]:>8.2f} '
+                  f'{t["max"]:>7.2f} {t["http"]:>7.2f} {t["retries"]:>7} '
+                  f'{t["throttles"]:>9} {t["errors"]:>6}', file=sys.stderr)
+
+
+_tracer = None
+
+
+def configure_trace():
+    """Start recording API calls on clients created from now on"""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def trace_span(name, category, **args):
+    """Context manager recording a span when --trace is on"""
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.span(name, category, **args)
+
+
+# EC2's default request rate limits per account and region, as requests per
+# second refilled and bucket size. Describe and other read only calls share
+# one bucket, calls that change resources share the other.
+DEFAULT_API_RATES = {
+    'describe': (20.0, 100),
+    'mutate': (5.0, 200),
+}
+_READ_ONLY_PREFIXES = ('Describe', 'Get', 'List')
+
+
+def api_category(operation):
+    """'describe' for read only operations, 'mutate' for the rest"""
+    return ('describe' if operation.startswith(_READ_ONLY_PREFIXES)
+            else 'mutate')
+
+
+def parse_api_rate(value):
+    """--api_rate value as (category, rate, burst or None for the default)"""
+    category, _, rate = value.partition('=')
+    if category not in DEFAULT_API_RATES:
+        raise argparse.ArgumentTypeError(
+            f'unknown category {category!r}, expected one of '
+            f'{", ".join(DEFAULT_API_RATES)}')
+    rate, _, burst = rate.partition('/')
+    try:
+        rate, burst = float(rate), int(burst) if burst else None
+        if rate <= 0 or (burst is not None and burst < 1):
+            raise ValueError(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f'expected CATEGORY=RATE[/BURST], got {value!r}') from None
+    return category, rate, burst
+
+
+class TokenBucket:
+    """Allows rate requests per second on average and bursts of capacity"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens
+                                  + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class ConcurrencyWindow:
+    """Limit on API calls in flight, adjusted to throttling
+
+    Halves on a throttling error and grows back by one call per window of
+    successful calls, so a run settles just under the rate the account
+    allows instead of retrying into the limit.
+    """
+
+    def __init__(self, limit, minimum=1):
+        self.maximum = max(minimum, limit)
+        self.minimum = minimum
+        self.limit = float(self.maximum)
+        self.in_flight = 0
+        self._decreased = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, success=True):
+        with self._condition:
+            self.in_flight -= 1
+            if success:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def throttled(self):
+        with self._condition:
+            now = time.monotonic()
+            # Calls already in flight when throttling started all fail,
+            # count them as one event
+            if now - self._decreased < 1.0:
+                return
+            self._decreased = now
+            self.limit = max(self.minimum, self.limit / 2)
+
+
+class RateLimiter:
+    """Process wide API rate limiting shared by every client
+
+    Keeps a token bucket per region and API category, taken from before
+    each HTTP attempt including retries, and a concurrency window per region
+    held for the whole call.
+    """
+
+    def __init__(self, rates=None, concurrency=DEFAULT_MAX_POOL_CONNECTIONS):
+        self.rates = dict(DEFAULT_API_RATES, **(rates or {}))
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._windows = {}
+
+    def bucket(self, region, category):
+        with self._lock:
+            key = (region, category)
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(*self.rates[category])
+            return self._buckets[key]
+
+    def window(self, region):
+        with self._lock:
+            if region not in self._windows:
+                self._windows[region] = ConcurrencyWindow(self.concurrency)
+            return self._windows[region]
+
+    def register(self, events):
+        events.register('before-call', self._before_call)
+        events.register('before-send', self._before_send)
+        events.register('response-received', self._response_received)
+        events.register('after-call', self._after_call)
+        events.register('after-call-error', self._after_call_error)
+
+    def _before_call(self, model, context, **kwargs):
+        window = self.window(context.get('client_region'))
+        window.acquire()
+        context['rate_limit'] = (window, api_category(model.name))
+
+    def _before_send(self, request, **kwargs):
+        limit = request.context.get('rate_limit')
+        if limit is not None:
+            self.bucket(request.context.get('client_region'),
+                        limit[1]).acquire()
+
+    def _response_received(self, context, parsed_response=None, **kwargs):
+        limit = context.get('rate_limit')
+        code = (parsed_response or {}).get('Error', {}).get('Code')
+        if limit is not None and code in THROTTLE_CODES:
+            limit[0].throttled()
+
+    def _release(self, context, success):
+        limit = context.pop('rate_limit', None)
+        if limit is not None:
+            limit[0].release(success)
+
+    def _after_call(self, context, parsed=None, **kwargs):
+        self._release(context, 'Error' not in (parsed or {}))
+
+    def _after_call_error(self, context, **kwargs):
+        self._release(context, False)
+
+
+_rate_limiter = None
+
+
+def configure_rate_limit(rates=None, concurrency=DEFAULT_MAX_POOL_CONNECTIONS):
+    """Rate limit API calls of clients created from now on"""
+    global _rate_limiter
+    _rate_limiter = RateLimiter(rates, concurrency)
+    return _rate_limiter
+
+
+def _resource_state(resource):
+    state = resource.get('State')
+    return state.get('Name') if isinstance(state, dict) else state
+
+
+# How to poll each resource type: describe operation, result key, id filter,
+# id field and the state a resource is ready in. None means the resource is
+# ready as soon as it can be described.
+_WAITABLE = {
+    'vpc': ('describe_vpcs', 'Vpcs', 'vpc-id', 'VpcId', 'available'),
+    'subnet': ('describe_subnets', 'Subnets', 'subnet-id', 'SubnetId',
+               'available'),
+    'internet-gateway': ('describe_internet_gateways', 'InternetGateways',
+                         'internet-gateway-id', 'InternetGatewayId', None),
+    'security-group': ('describe_security_groups', 'SecurityGroups',
+                       'group-id', 'GroupId', None),
+    'instance': ('describe_instances', 'Reservations', 'instance-id',
+                 'InstanceId', 'running'),
+}
+
+_ID_FIELDS = {
+    'vpc': 'VpcId',
+    'subnet': 'SubnetId',
+    'internet-gateway': 'InternetGatewayId',
+    'route-table': 'RouteTableId',
+    'security-group': 'GroupId',
+    'instance': 'InstanceId',
+}
+
+# Instance states that can't turn into the one being waited for. Instances
+# just started can still be reported stopped, so that isn't one for running.
+_INSTANCE_DEAD_ENDS = {
+    'running': {'shutting-down', 'terminated', 'stopping'},
+    'stopped': {'shutting-down', 'terminated'},
+}
+
+# Most values EC2 accepts in one filter
+_FILTER_VALUES = 200
+
+
+def wait_for(session, resources, states=None, timeout=WAIT_TIMEOUT,
+             initial_delay=WAIT_INITIAL_DELAY, max_delay=WAIT_MAX_DELAY):
+    """Wait until resources of mixed types are ready
+
+    resources maps resource type to ids, e.g. {'vpc': [...], 'subnet': [...]}.
+    states optionally overrides the state waited for per type, 'deleted'
+    waits for resources to disappear. Each round makes one describe call
+    per type (per 200 ids) for everything still pending, the types in
+    parallel. Polling starts after initial_delay and backs off exponentially
+    with jitter up to max_delay.
+    """
+    states = states or {}
+    pending = {t: set(ids) for t, ids in resources.items() if ids}
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+
+    def poll(resource_type, ids):
+        operation, result_key, id_filter, id_field, ready_state = \
+            _WAITABLE[resource_type]
+        target = states.get(resource_type, ready_state)
+        seen = {}
+        ids = sorted(ids)
+        for i in range(0, len(ids), _FILTER_VALUES):
+            filters = [{'Name': id_filter,
+                        'Values': ids[i:i + _FILTER_VALUES]}]
+            for resource in paginate(session, operation, result_key,
+                                     Filters=filters):
+                seen[resource[id_field]] = _resource_state(resource)
+
+        if target == 'deleted':
+            return {i for i in ids if i in seen and seen[i] != 'deleted'}
+        dead = _INSTANCE_DEAD_ENDS.get(target, set())
+        failed = [i for i in ids
+                  if resource_type == 'instance' and seen.get(i) in dead]
+        if failed:
+            raise RuntimeError(f'{resource_type} {failed} will not become '
+                               f'{target}')
+        return {i for i in ids
+                if i not in seen or (target and seen[i] != target)}
+
+    label = ','.join(sorted(pending))
+    executor = ContextThreadPoolExecutor(max_workers=len(_WAITABLE))
+    with executor, trace_span(label, 'wait', resources=resources):
+        while pending:
+            time.sleep(random.uniform(delay / 2, delay))
+            futures = {t: executor.submit(poll, t, ids)
+                       for t, ids in pending.items()}
+            pending = {t: f.result() for t, f in futures.items()
+                       if f.result()}
+            if pending and time.monotonic() > deadline:
+                raise TimeoutError(f'Timed out waiting for {pending}')
+            delay = min(delay * 2, max_delay)
+
+
+def field_projection(fields):
+    """Compiled JMESPath expression for --fields, or None
+
+    A comma separated list of names or dotted paths such as
+    VpcId,State,Tags is turned into a hash keyed by the paths.
+    """
+    if not fields:
+        return None
+    import jmespath
+    if re.fullmatch(r'[\w.]+(,[\w.]+)*', fields):
+        fields = '{%s}' % ', '.join(f'"{f}": {f}' for f in fields.split(','))
+    return jmespath.compile(fields)
+
+
+def print_ndjson(items, fields=None):
+    """Print each item as one line of JSON, projected by --fields"""
+    projection = field_projection(fields)
+    for item in items:
+        if projection is not None:
+            item = projection.search(item)
+        print(json.dumps(item, default=str))
+
+
+_states = {}
+
+
+def get_state():
+    """The state store of the current region and working directory"""
+    path = (output_dir() / 'state.json').resolve()
+    with _registry_lock:
+        if path not in _states:
+            _states[path] = StateStore(path)
+        return _states[path]
+
+
+def positive_int(value):
+    """Integer option value that must be at least 1"""
+    try:
+        number = int(value)
+    except ValueError:
+        number = None
+    if number is None or number < 1:
+        raise argparse.ArgumentTypeError(
+            f'expected a whole number of at least 1, got {value!r}')
+    return number
+
+
+def subnet_prefix_length(value):
+    """Subnet prefix length option value in the range EC2 allows"""
+    try:
+        number = int(value)
+    except ValueError:
+        number = None
+    if number not in SUBNET_PREFIX_RANGE:
+        raise argparse.ArgumentTypeError(
+            f'expected a prefix length from {SUBNET_PREFIX_RANGE[0]} to '
+            f'{SUBNET_PREFIX_RANGE[-1]}, got {value!r}')
+    return number
+
+
+def main(argv=None, serving=False):
+    """"""
+    if argv is None:
+        argv = sys.argv[1:]
+    start = time.perf_counter()
+    # The serve daemon loaded its imports before the command was sent
+    started = start if serving else _IMPORTS_STARTED
+    _startup_timing.clear()
+    if not serving:
+        _startup_timing['imports'] = start - _IMPORTS_STARTED
+    try:
+        _main(argv, start, serving)
+    finally:
+        if '--startup_timing' in argv:
+            _startup_timing['total'] = time.perf_counter() - started
+            print_startup_timing('Serve daemon timing' if serving
+                                 else 'Startup timing')
 
 
-def main():
+def _main(argv, start, serving=False):
     """"""
     parser = argparse.ArgumentParser(
         description='Demo: Create AWS infrastructure with Python')
     parser.add_argument('--verbose', '-v', action='store_true', help='')
     parser.add_argument('--profile', action='store', default='demo',
                         help='AWS profile name, defaults to "demo"')
-    parser.add_argument('--region', action='store', default='ap-southeast-2',
-                        help='AWS region, defaults to "ap-southeast-2"')
+    parser.add_argument('--region', action='store', default=DEFAULT_REGION,
+                        help='AWS region, a comma separated list or "all", '
+                             f'defaults to "{DEFAULT_REGION}"')
+    parser.add_argument('--region_workers', action='store', type=positive_int,
+                        default=DEFAULT_WORKERS,
+                        help='Regions to work on at the same time')
     parser.add_argument('--debug', '-d', action='store_true',
                         help='Enable debugging')
+    parser.add_argument('--max_pool_connections', action='store',
+                        type=positive_int,
+                        default=DEFAULT_MAX_POOL_CONNECTIONS,
+                        help='HTTP connections kept open per AWS client')
+    parser.add_argument('--api_rate', action='append', default=[],
+                        type=parse_api_rate, metavar='CATEGORY=RATE[/BURST]',
+                        help='Requests per second and burst allowed for '
+                             'describe or mutate calls, e.g. mutate=5/200')
+    parser.add_argument('--no_rate_limit', action='store_true',
+                        help='Send API calls as fast as the workers can')
+    parser.add_argument('--max_attempts', action='store', type=positive_int,
+                        default=DEFAULT_MAX_ATTEMPTS,
+                        help='Attempts per API call, including retries of '
+                             'throttled calls')
+    parser.add_argument('--startup_timing', action='store_true',
+                        help='Report import and argument parsing time')
+    parser.add_argument('--trace', action='store_true',
+                        help='Record every API call and wait, write them as '
+                             'a Chrome trace and print the slowest')
+    parser.add_argument('--trace_file', action='store',
+                        default=str(Path('outputs') / 'trace.json'),
+                        help='Where --trace writes the Chrome trace, '
+                             'defaults to outputs/trace.json')
+    parser.add_argument('--connect', action='store', metavar='SOCKET',
+                        default=os.environ.get('CLI_SOCKET'),
+                        help='Run the command in the serve daemon listening '
+                             'on SOCKET, defaults to $CLI_SOCKET')
+    parser.add_argument('--cache', action='store_true',
+                        help='Cache describe results in outputs/')
+    parser.add_argument('--cache_ttl', action='append', default=[],
+                        type=parse_cache_ttl, metavar='[TYPE=]SECONDS',
+                        help='Cache lifetime for all or one resource type, '
+                             f'e.g. subnet=300, default {DEFAULT_CACHE_TTL}')
+    parser.add_argument('--cache_size', action='store', type=int,
+                        default=DEFAULT_CACHE_SIZE,
+                        help='Cached describe results to keep')
+    parser.add_argument('--metadata_ttl', action='append', default=[],
+                        type=parse_metadata_ttl, metavar='KIND=SECONDS',
+                        help='Lifetime of cached az or ami lookups, '
+                             'defaults to '
+                             f"az={DEFAULT_METADATA_TTLS['az']} "
+                             f"ami={DEFAULT_METADATA_TTLS['ami']}")
 
     subparsers = parser.add_subparsers(
         title='AWS Service',
@@ -47,9 +1545,18 @@ def main():
         metavar='service',
         dest='service'
     )
+    # Options shared by every service with an info action
+
+    info_options = argparse.ArgumentParser(add_help=False)
+    info_options.add_argument(
+        '--fields', action='store',
+        help='Fields to output for info, e.g. VpcId,State,Tags or a '
+             'JMESPath expression such as "{id: VpcId, cidr: CidrBlock}"')
+
     # VPC options
 
-    parser_vpc = subparsers.add_parser('vpc', help='Work on VPC')
+    parser_vpc = subparsers.add_parser(
+        'vpc', help='Work on VPC', parents=[info_options])
     parser_vpc.add_argument('--action', choices=['create', 'info'],
                             action='store', required=True)
     parser_vpc.add_argument('--vpc_name', action='store', default='demo',
@@ -58,16 +1565,31 @@ def main():
 
     # Subnet options
 
-    parser_subnet = subparsers.add_parser('subnet', help='VPC subnets')
+    parser_subnet = subparsers.add_parser(
+        'subnet', help='VPC subnets', parents=[info_options])
     parser_subnet.add_argument('--action', choices=['create', 'info'],
                                action='store', required=True)
     parser_subnet.add_argument('--name_prefix', action='store',
                                default=DEFAULT_NAME, help='Subnet name prefix')
+    parser_subnet.add_argument('--workers', action='store', type=positive_int,
+                               default=DEFAULT_WORKERS,
+                               help='Subnets to create at the same time')
+    parser_subnet.add_argument('--per_az', action='store', type=positive_int,
+                               default=DEFAULT_SUBNETS_PER_AZ,
+                               help='Subnets wanted in each availability '
+                                    'zone')
+    parser_subnet.add_argument('--prefix_length', action='store',
+                               type=subnet_prefix_length,
+                               default=DEFAULT_SUBNET_PREFIX,
+                               help='Size of new subnets from /16 to /28, '
+                                    'e.g. 24 for /24, defaults to '
+                                    f'{DEFAULT_SUBNET_PREFIX}')
     parser_subnet.set_defaults(func=subnet)
 
     # Internet Gateway options
 
-    parser_igw = subparsers.add_parser('igw', help='Internet Gateway')
+    parser_igw = subparsers.add_parser(
+        'igw', help='Internet Gateway', parents=[info_options])
     parser_igw.add_argument('--action', choices=['create', 'info', 'attach'],
                             action='store', required=True)
     parser_igw.add_argument('--name', action='store',
@@ -77,45 +1599,452 @@ def main():
 
     # Route Table options
 
-    parser_rt = subparsers.add_parser('route_table', help='Route Table')
+    parser_rt = subparsers.add_parser(
+        'route_table', help='Route Table', parents=[info_options])
     parser_rt.add_argument(
         '--action', action='store', required=True,
-        choices=['create', 'info', 'associate_subnet', 'add_route']
+        choices=['create', 'info', 'associate_subnet', 'add_route',
+                 'sync_routes']
     )
     parser_rt.add_argument('--name', action='store',
                            default=DEFAULT_NAME,
                            help='Prefix to route table name')
+    parser_rt.add_argument('--routes_file', action='store',
+                           help='Routes for sync_routes, one "CIDR TARGET" '
+                                'per line, e.g. "10.1.0.0/16 pcx-0123"')
+    parser_rt.add_argument('--workers', action='store', type=positive_int,
+                           default=DEFAULT_WORKERS,
+                           help='Route and association calls to make at the '
+                                'same time')
     parser_rt.set_defaults(func=rt)
 
     # EC2 options
 
-    parser_ec2 = subparsers.add_parser('ec2', help='Elastic Compute Cloud')
+    parser_ec2 = subparsers.add_parser(
+        'ec2', help='Elastic Compute Cloud', parents=[info_options])
     parser_ec2.add_argument(
         '--action', action='store', required=True,
-        choices=['create', 'info', 'import_ssh_key']
+        choices=['create', 'info', 'import_ssh_key', 'pool', 'acquire',
+                 'release']
     )
     parser_ec2.add_argument('--name', action='store', default=DEFAULT_NAME,
                             help='Name tag of EC2 instance')
+    parser_ec2.add_argument('--count', action='store', type=positive_int,
+                            default=1,
+                            help='Instances wanted with the Name tag, '
+                                 'create launches the ones missing, pool '
+                                 'keeps this many stopped, acquire starts '
+                                 'this many')
+    parser_ec2.add_argument('--pool_size', action='store', type=int,
+                            help='Stopped instances acquire backfills the '
+                                 'pool to, by default as many as it had')
+    parser_ec2.add_argument('--instance_ids', action='store',
+                            help='Instances release returns to the pool, '
+                                 'comma separated, by default all acquired')
+    parser_ec2.add_argument('--chunk_size', action='store', type=positive_int,
+                            default=DEFAULT_CHUNK_SIZE,
+                            help='Most instances launched by one API call')
+    parser_ec2.add_argument('--workers', action='store', type=positive_int,
+                            default=DEFAULT_WORKERS,
+                            help='Launch calls to make at the same time')
+    parser_ec2.add_argument('--ami', action='store',
+                            help='Image to launch, by default the newest '
+                                 'matching --ami_name')
+    parser_ec2.add_argument('--ami_name', action='store',
+                            default=DEFAULT_AMI_NAME,
+                            help='Image name pattern, defaults to '
+                                 f'{DEFAULT_AMI_NAME}')
+    parser_ec2.add_argument('--ami_owner', action='store',
+                            default=DEFAULT_AMI_OWNER,
+                            help='Owner of the image, defaults to '
+                                 f'{DEFAULT_AMI_OWNER}')
     parser_ec2.set_defaults(func=ec2)
 
     # Security Group options
 
-    parser_sg = subparsers.add_parser('security_group', help='Security Group')
+    parser_sg = subparsers.add_parser(
+        'security_group', help='Security Group', parents=[info_options])
     parser_sg.add_argument('--action', action='store', required=True,
-                           choices=['create', 'info'])
+                           choices=['create', 'info', 'apply_rules'])
     parser_sg.add_argument('--name', action='store', default=DEFAULT_NAME,
                            help='Security group name')
+    parser_sg.add_argument('--rules_file', action='store',
+                           help='Ingress rules for apply_rules, one '
+                                '"PROTOCOL PORT[-PORT] CIDR" or '
+                                '"icmp [TYPE[/CODE]] CIDR" per line')
+    parser_sg.add_argument('--batch_size', action='store', type=positive_int,
+                           default=DEFAULT_RULE_BATCH,
+                           help='Most rules added or revoked by one call')
     parser_sg.set_defaults(func=security_group)
 
+    # Apply options
+
+    parser_apply = subparsers.add_parser(
+        'apply', help='Provision the whole stack in one run')
+    parser_apply.add_argument('--name', action='store', default=DEFAULT_NAME,
+                              help='Name of the stack, defaults to "demo"')
+    parser_apply.add_argument('--workers', action='store', type=positive_int,
+                              default=DEFAULT_WORKERS,
+                              help='Steps to run at the same time')
+    parser_apply.set_defaults(func=apply)
+
+    # Resume options
+
+    parser_resume = subparsers.add_parser(
+        'resume', help='Continue a failed apply from its journal')
+    parser_resume.add_argument('--name', action='store', default=DEFAULT_NAME,
+                               help='Name of the stack, defaults to "demo"')
+    parser_resume.add_argument('--workers', action='store', type=positive_int,
+                               default=DEFAULT_WORKERS,
+                               help='Steps to run at the same time')
+    parser_resume.set_defaults(func=resume)
+
+    # Plan options
+
+    parser_plan = subparsers.add_parser(
+        'plan', help='Show the API calls apply would make')
+    parser_plan.add_argument('--name', action='store', default=DEFAULT_NAME,
+                             help='Name of the stack, defaults to "demo"')
+    parser_plan.set_defaults(func=plan)
+
+    # Destroy options
+
+    parser_destroy = subparsers.add_parser(
+        'destroy', help='Delete every resource of a stack')
+    parser_destroy.add_argument('--name', action='store',
+                                default=DEFAULT_NAME,
+                                help='Name of the stack, defaults to "demo"')
+    parser_destroy.add_argument('--workers', action='store', type=positive_int,
+                                default=DEFAULT_WORKERS,
+                                help='Deletions to run at the same time')
+    parser_destroy.add_argument('--yes', action='store_true',
+                                help='Delete, otherwise only list what '
+                                     'would be deleted')
+    parser_destroy.set_defaults(func=destroy)
+
+    # Watch options
+
+    parser_watch = subparsers.add_parser(
+        'watch', help='Print changes to stacks as NDJSON as they happen')
+    parser_watch.add_argument('--name', action='store', default=DEFAULT_NAME,
+                              help='Stacks to watch, comma separated, '
+                                   'defaults to "demo"')
+    parser_watch.add_argument('--interval', action='store', type=float,
+                              default=DEFAULT_WATCH_INTERVAL,
+                              help='Seconds between polls after a change, '
+                                   f'defaults to {DEFAULT_WATCH_INTERVAL}')
+    parser_watch.add_argument('--max_interval', action='store', type=float,
+                              default=DEFAULT_WATCH_MAX_INTERVAL,
+                              help='Longest wait between polls, defaults to '
+                                   f'{DEFAULT_WATCH_MAX_INTERVAL}')
+    parser_watch.add_argument('--count', action='store', type=int,
+                              default=0,
+                              help='Stop after this many polls')
+    parser_watch.set_defaults(func=watch)
+
+    # Serve options
+
+    parser_serve = subparsers.add_parser(
+        'serve', help='Run commands sent over a Unix socket with --connect')
+    parser_serve.add_argument('--socket', action='store',
+                              default=str(DEFAULT_SOCKET),
+                              help='Socket to listen on, defaults to '
+                                   f'{DEFAULT_SOCKET}')
+    parser_serve.set_defaults(func=serve)
+
+    # Inventory options
+
+    parser_inventory = subparsers.add_parser(
+        'inventory', help='Describe every resource of a stack at once')
+    parser_inventory.add_argument('--name', action='store',
+                                  default=DEFAULT_NAME,
+                                  help='Name of the stack, defaults to "demo"')
+    parser_inventory.set_defaults(func=inventory)
+
     # Handle arguments
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    _startup_timing['parse'] = time.perf_counter() - start
     if not args.service:
         print(f'DEBUG: args: {args}\n')
         parser.print_usage()
         parser.exit(message='Select a service to work on.\n')
 
-    args.func(args)
+    if args.connect and not serving and args.service != 'serve':
+        code = forward(args.connect, argv)
+        if code:
+            parser.exit(code)
+        return
+    if args.service == 'serve' and serving:
+        parser.error('serve: already serving')
+    if (args.service == 'route_table' and args.action == 'sync_routes'
+            and not args.routes_file):
+        parser_rt.error('--action sync_routes needs --routes_file')
+    if args.service == 'watch' and serving and not args.count:
+        # A daemon command holds the daemon until it ends
+        parser.error('watch: --count is needed with --connect')
+
+    # The daemon's clients, limits and caches are shared by every command
+    tracer = None if serving else configure(args)
+    start = time.perf_counter()
+    try:
+        if args.service == 'serve':
+            ok = serve(args)
+        else:
+            ok = run_regions(args)
+    finally:
+        if tracer is not None:
+            tracer.write(args.trace_file)
+            tracer.summary()
+    _startup_timing['command'] = time.perf_counter() - start
+    if not ok:
+        parser.exit(1)
+
+
+def configure(args):
+    """Set up clients, rate limits, caching and tracing from the options
+
+    Returns the tracer when --trace is on.
+    """
+    configure_clients(max_pool_connections=args.max_pool_connections,
+                      max_attempts=args.max_attempts)
+    if not args.no_rate_limit:
+        rates = {}
+        for category, rate, burst in args.api_rate:
+            rates[category] = (rate, burst or DEFAULT_API_RATES[category][1])
+        configure_rate_limit(rates, concurrency=args.max_pool_connections)
+    if args.cache:
+        ttl, ttls = DEFAULT_CACHE_TTL, {}
+        for resource_type, seconds in args.cache_ttl:
+            if resource_type:
+                ttls[resource_type] = seconds
+            else:
+                ttl = seconds
+        configure_describe_cache(ttl=ttl, ttls=ttls,
+                                 max_entries=args.cache_size)
+    configure_metadata_cache(dict(args.metadata_ttl))
+    return configure_trace() if args.trace else None
+
+
+def list_regions(profile=None):
+    """Names of the regions enabled for the account"""
+    client = get_client(get_session(profile, DEFAULT_REGION))
+    return sorted(r['RegionName'] for r in
+                  client.describe_regions()['Regions'])
+
+
+def run_regions(args):
+    """Run the selected command in each region of --region
+
+    Every region gets its own session and its own outputs/<region>/
+    directory. With more than one region they run concurrently and a report
+    with per region timings is printed at the end. Returns False when the
+    command raised or returned False in any region.
+    """
+    if args.region == 'all':
+        regions = list_regions(args.profile)
+    else:
+        regions = [r.strip() for r in args.region.split(',') if r.strip()]
+
+    def run(region):
+        _output_dir.set(Path('outputs') / region)
+        region_args = argparse.Namespace(**vars(args))
+        region_args.region = region
+        start = time.perf_counter()
+        try:
+            ok = region_args.func(region_args) is not False
+        except Exception as e:
+            if len(regions) == 1:
+                raise
+            print(f'ERROR: {region}: {e}')
+            return {'status': 'error', 'error': str(e),
+                    'seconds': time.perf_counter() - start}
+        return {'status': 'ok' if ok else 'failed',
+                'seconds': time.perf_counter() - start}
+
+    if len(regions) == 1:
+        return run(regions[0])['status'] == 'ok'
+
+    start = time.perf_counter()
+    executor = ContextThreadPoolExecutor(max_workers=args.region_workers)
+    with executor:
+        results = dict(zip(regions, executor.map(run, regions)))
+    print(json.dumps({
+        'regions': results,
+        'seconds': time.perf_counter() - start,
+    }, indent=2))
+    return all(r['status'] == 'ok' for r in results.values())
+
+
+class ClientGone(BaseException):
+    """The client of a serve command went away
+
+    Raised from the command's output writes to stop it. Not an Exception,
+    so handlers that report errors and carry on don't catch it.
+    """
+
+
+class _FrameWriter(io.TextIOBase):
+    """Text stream sending what is written as JSON line frames
+
+    {"stdout": text} or {"stderr": text}, see forward(). Writing or
+    flushing once the client went away raises ClientGone.
+    """
+
+    def __init__(self, connection, wfile, stream, lock):
+        self.connection = connection
+        self.wfile = wfile
+        self.stream = stream
+        self._lock = lock
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        # Clients send nothing after the request, the socket only becomes
+        # readable once they close it
+        readable, _, _ = select.select([self.connection], [], [], 0)
+        try:
+            gone = readable and not self.connection.recv(1, socket.MSG_PEEK)
+        except OSError:
+            gone = True
+        if gone:
+            raise ClientGone()
+
+    def write(self, text):
+        with self._lock:
+            if text:
+                frame = json.dumps({self.stream: text}) + '\n'
+                try:
+                    self.wfile.write(frame.encode())
+                    self.wfile.flush()
+                except OSError as e:
+                    raise ClientGone() from e
+        return len(text)
+
+
+class _CommandHandler(socketserver.StreamRequestHandler):
+    """Runs one command sent by forward() and streams its output back"""
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        request = json.loads(line)
+        lock = threading.Lock()
+        stdout = _FrameWriter(self.connection, self.wfile, 'stdout', lock)
+        stderr = _FrameWriter(self.connection, self.wfile, 'stderr', lock)
+        code = 0
+        # stdout, stderr and the working directory are process wide
+        with self.server.command_lock:
+            cwd = os.getcwd()
+            try:
+                os.chdir(request.get('cwd', cwd))
+                with contextlib.redirect_stdout(stdout), \
+                        contextlib.redirect_stderr(stderr):
+                    try:
+                        main(request.get('argv', []), serving=True)
+                    except SystemExit as e:
+                        if e.code is None or isinstance(e.code, int):
+                            code = e.code or 0
+                        else:
+                            print(e.code, file=sys.stderr)
+                            code = 1
+                    except Exception:
+                        traceback.print_exc()
+                        code = 1
+            except ClientGone:
+                return
+            finally:
+                os.chdir(cwd)
+        with lock, contextlib.suppress(OSError):
+            self.wfile.write((json.dumps({'exit': code}) + '\n').encode())
+
+
+class CommandServer(socketserver.ThreadingUnixStreamServer):
+    """Unix socket server running CLI commands one at a time"""
+
+    daemon_threads = True
+
+    def __init__(self, path):
+        self.command_lock = threading.Lock()
+        super().__init__(str(path), _CommandHandler)
+
+
+def serve(args):
+    """Run commands sent by clients with --connect, keeping sessions warm
+
+    Sessions, clients, the tag index, and the state stores, journals and
+    caches of each working directory clients run commands in live as long
+    as the daemon. State is read again when its file changed. Client, rate
+    limit, cache and trace options are the daemon's own, those given with
+    a command are ignored.
+    """
+    path = Path(args.socket)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.exists():
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(str(path))
+            except OSError:
+                path.unlink()
+            else:
+                print(f'ERROR: A daemon is already serving on {path}')
+                return False
+
+    # Resolve credentials and build clients before the first command
+    if args.region != 'all':
+        for region in args.region.split(','):
+            get_client(get_session(args.profile, region.strip()))
+
+    with CommandServer(path) as server:
+        os.chmod(path, 0o600)
+        print(f'Serving on {path}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            path.unlink()
+    return True
+
+
+def _without_connect(argv):
+    """argv without its --connect option"""
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == '--connect':
+            skip = True
+        elif not arg.startswith('--connect='):
+            result.append(arg)
+    return result
+
+
+def forward(path, argv):
+    """Run a command in the serve daemon on path, return its exit status"""
+    request = {'argv': _without_connect(argv), 'cwd': os.getcwd()}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(path))
+        except OSError as e:
+            print(f'ERROR: No serve daemon on {path}: {e}', file=sys.stderr)
+            return 1
+        with sock.makefile('rwb') as fo:
+            fo.write((json.dumps(request) + '\n').encode())
+            fo.flush()
+            for line in fo:
+                frame = json.loads(line)
+                if 'exit' in frame:
+                    return frame['exit']
+                for name, text in frame.items():
+                    stream = sys.stdout if name == 'stdout' else sys.stderr
+                    stream.write(text)
+                    stream.flush()
+    print('ERROR: Lost the connection to the serve daemon', file=sys.stderr)
+    return 1
 
 
 def vpc(args):
@@ -124,25 +2053,24 @@ def vpc(args):
         print('VPC')
         print(f'args: {args}')
 
-    session = boto3.session.Session(profile_name=args.profile,
-                                    region_name=args.region)
+    session = get_session(args.profile, args.region)
     if args.action == 'info':
-        vpcs = vpc_info(session, vpc_name=args.vpc_name)
-        if vpcs:
-            print(json.dumps(vpcs))
+        vpcs = vpc_info(session, vpc_name=args.vpc_name, stream=True)
+        print_ndjson(vpcs, fields=args.fields)
 
     elif args.action == 'create':
-        vpcs = vpc_info(session, vpc_name=args.vpc_name)
-        if not vpcs:
-            vpc_create(session)
+        if not resource_id(session, 'vpc', args.vpc_name):
+            vpc_create(session, tags=[{'Key': 'Name',
+                                       'Value': args.vpc_name}])
         else:
             print('VPC already exists')
 
 
-def vpc_info(session, vpc_name=DEFAULT_NAME, cidr=DEFAULT_CIDR):
-    """VPC Info"""
-    client = session.client('ec2')
-    response = client.describe_vpcs(
+def vpc_info(session, vpc_name=DEFAULT_NAME, cidr=DEFAULT_CIDR,
+             stream=False):
+    """VPC Info, a generator of VPCs when stream is True"""
+    vpcs = describe(
+        session, 'describe_vpcs', 'vpc', 'Vpcs',
         Filters=[
             {
                 'Name': 'tag:Name',
@@ -154,13 +2082,13 @@ def vpc_info(session, vpc_name=DEFAULT_NAME, cidr=DEFAULT_CIDR):
             },
         ]
     )
-    return response.get('Vpcs', None)
+    return vpcs if stream else list(vpcs)
 
 
 def vpc_create(session, cidr=DEFAULT_CIDR,
                tags=[{'Key': 'Name', 'Value': DEFAULT_NAME}]):
     """"""
-    ec2_client = session.client('ec2')
+    ec2_client = get_client(session)
     response = ec2_client.create_vpc(
         CidrBlock=cidr,
         InstanceTenancy='default',
@@ -173,36 +2101,110 @@ def vpc_create(session, cidr=DEFAULT_CIDR,
     )
 
     vpc_id = response.get('Vpc', {}).get('VpcId')
-    waiter = ec2_client.get_waiter('vpc_available')
-    waiter.wait(
-        VpcIds=[vpc_id],
-    )
+    wait_for(session, {'vpc': [vpc_id]})
     print(f'VPC created: {vpc_id}')
+    name = next((t['Value'] for t in tags if t['Key'] == 'Name'), vpc_id)
+    get_state().put('vpc', name, vpc_id, response.get('Vpc'))
     write_output_json('vpc.json', response)
 
 
-def get_vpc_id():
-    """"""
-    vpc_json = Path.cwd() / 'outputs' / 'vpc.json'
-    if not vpc_json.exists():
-        return None
-
-    with open(vpc_json, 'r') as fo:
-        vpc_data = json.load(fo)
-    return vpc_data.get('Vpc', {}).get('VpcId', None)
+def get_vpc_id(session, name=DEFAULT_NAME):
+    """Id of the named VPC, or None, see resource_id()"""
+    return resource_id(session, 'vpc', name)
 
 
 def get_availability_zones(session):
-    """"""
-    client = session.client('ec2')
-    az_response = client.describe_availability_zones(Filters=[{
-        'Name': 'group-name',
-        'Values': ['ap-southeast-2']
-    }])
-    azs = []
-    for az in az_response.get('AvailabilityZones', None):
-        azs.append(az.get('ZoneName', None))
-    return azs
+    """Names of the session's region's availability zones, cached"""
+    def fetch():
+        response = get_client(session).describe_availability_zones(
+            Filters=[
+                {'Name': 'region-name', 'Values': [session.region_name]},
+                {'Name': 'zone-type', 'Values': ['availability-zone']},
+                {'Name': 'state', 'Values': ['available']},
+            ])
+        return sorted(az['ZoneName']
+                      for az in response.get('AvailabilityZones', []))
+    return metadata_cache().get(
+        'az', (session.profile_name, session.region_name), fetch)
+
+
+def latest_ami(session, name=DEFAULT_AMI_NAME, owner=DEFAULT_AMI_OWNER):
+    """Id of the newest available image matching a name pattern, cached"""
+    def fetch():
+        images = list(paginate(session, 'describe_images', 'Images',
+                               Owners=[owner], Filters=[
+                                   {'Name': 'name', 'Values': [name]},
+                                   {'Name': 'state', 'Values': ['available']},
+                               ]))
+        if not images:
+            raise ValueError(f'No {owner} image matches {name}')
+        return max(images, key=lambda i: (i.get('CreationDate', ''),
+                                          i['Name']))['ImageId']
+    return metadata_cache().get(
+        'ami', (session.profile_name, session.region_name, owner, name),
+        fetch)
+
+
+class CidrAllocator:
+    """Hands out non-overlapping blocks of a VPC's CIDR
+
+    Free space is kept as aligned blocks in a sorted list of addresses per
+    prefix length. A request takes the lowest free block of the smallest
+    size that fits and splits it, releasing a block merges it back with
+    its free neighbour, so both take a handful of list operations however
+    many subnets the VPC has.
+    """
+
+    def __init__(self, cidr=DEFAULT_CIDR, used=()):
+        self.network = ipaddress.ip_network(cidr)
+        self.free = {}
+        used = sorted(n for n in map(ipaddress.ip_network, used)
+                      if n.subnet_of(self.network))
+        start = int(self.network.network_address)
+        for network in used + [None]:
+            end = (int(network.network_address) if network
+                   else int(self.network.broadcast_address) + 1)
+            if start < end:
+                for block in ipaddress.summarize_address_range(
+                        ipaddress.ip_address(start),
+                        ipaddress.ip_address(end - 1)):
+                    self._add(int(block.network_address), block.prefixlen)
+            if network:
+                start = max(start, int(network.broadcast_address) + 1)
+
+    def _size(self, prefixlen):
+        return 1 << (self.network.max_prefixlen - prefixlen)
+
+    def _add(self, address, prefixlen):
+        bisect.insort(self.free.setdefault(prefixlen, []), address)
+
+    def allocate(self, prefixlen):
+        """Lowest free block with prefixlen, as an ip_network"""
+        for size in range(prefixlen, self.network.prefixlen - 1, -1):
+            if self.free.get(size):
+                address = self.free[size].pop(0)
+                break
+        else:
+            raise ValueError(f'No free /{prefixlen} left in {self.network}')
+        while size < prefixlen:
+            size += 1
+            self._add(address + self._size(size), size)
+        return ipaddress.ip_network((address, prefixlen))
+
+    def release(self, cidr):
+        """Give a block back, merging it with its free buddy blocks"""
+        network = ipaddress.ip_network(cidr)
+        address, prefixlen = int(network.network_address), network.prefixlen
+        while prefixlen > self.network.prefixlen:
+            buddy = address ^ self._size(prefixlen)
+            blocks = self.free.get(prefixlen, [])
+            index = bisect.bisect_left(blocks, buddy)
+            if index == len(blocks) or blocks[index] != buddy:
+                break
+            del blocks[index]
+            address = min(address, buddy)
+            prefixlen -= 1
+        self._add(address, prefixlen)
 
 
 def subnet(args):
@@ -211,69 +2213,129 @@ def subnet(args):
         print('Subnets')
         print(f'args: {args}')
 
-    session = boto3.session.Session(profile_name=args.profile,
-                                    region_name=args.region)
+    session = get_session(args.profile, args.region)
     if args.action == 'info':
-        subnets = subnet_info(session, name_prefix=args.name_prefix)
-        if subnets:
-            print(json.dumps(subnets))
+        if not get_vpc_id(session, args.name_prefix):
+            print(f'ERROR: VPC {args.name_prefix} not found, create it '
+                  'first.')
+            return
+        subnets = subnet_info(session, name_prefix=args.name_prefix,
+                              stream=True)
+        print_ndjson(subnets, fields=args.fields)
     elif args.action == 'create':
-        subnets = subnet_info(session)
-        if not subnets:
-            subnet_create(session)
-        else:
-            print('Subnets already exist:',
-                  [x.get('SubnetId', None) for x in subnets])
-
-
-def subnet_info(session, name_prefix=DEFAULT_NAME):
-    """"""
-    client = session.client('ec2')
-    response = client.describe_subnets(Filters=[
-        {
-            'Name': 'tag:Name',
-            'Values': [
-                'demo-ap-southeast-2a',
-                'demo-ap-southeast-2b',
-                'demo-ap-southeast-2c',
-            ]
-        },
-        {'Name': 'vpc-id', 'Values': [get_vpc_id()]}
-    ])
-    return response.get('Subnets', None)
+        subnet_create(session, name_prefix=args.name_prefix,
+                      max_workers=args.workers, per_az=args.per_az,
+                      prefix_length=args.prefix_length)
 
 
-def subnet_create(session,
-                  subnet_cidrs=['10.0.0.0/28', '10.0.0.16/28', '10.0.0.32/28']):
+def subnet_info(session, name_prefix=DEFAULT_NAME, stream=False):
     """"""
-    client = session.client('ec2')
-    azs = get_availability_zones(session)
-    print(f'AvailabilityZones: {azs}')
+    vpc_id = get_vpc_id(session, name_prefix)
+    subnets = describe(
+        session, 'describe_subnets', 'subnet', 'Subnets',
+        Filters=[
+            {
+                'Name': 'tag:Name',
+                'Values': [f'{name_prefix}-*']
+            },
+            {'Name': 'vpc-id', 'Values': [vpc_id]},
+        ]
+    )
+    return subnets if stream else list(subnets)
+
+
+def subnet_specs(azs, name_prefix=DEFAULT_NAME, subnet_cidrs=None,
+                 per_az=DEFAULT_SUBNETS_PER_AZ,
+                 prefix_length=DEFAULT_SUBNET_PREFIX, existing=(),
+                 vpc_cidr=DEFAULT_CIDR):
+    """[(name, availability zone, cidr)] spreading subnets across azs
+
+    Without subnet_cidrs there are per_az subnets in every zone. Those
+    named like a subnet in existing keep its CIDR, the others get free
+    /prefix_length blocks of vpc_cidr.
+    """
+    count = len(subnet_cidrs) if subnet_cidrs else per_az * len(azs)
+    specs = []
+    for idx in range(count):
+        az = azs[idx % len(azs)]
+        name = f'{name_prefix}-{az}'
+        if idx >= len(azs):
+            name = f'{name}-{idx // len(azs)}'
+        specs.append([name, az, subnet_cidrs[idx] if subnet_cidrs else None])
+    if not subnet_cidrs:
+        cidrs = {name_tag(s): s['CidrBlock'] for s in existing}
+        allocator = CidrAllocator(vpc_cidr,
+                                  [s['CidrBlock'] for s in existing])
+        for spec in specs:
+            spec[2] = (cidrs.get(spec[0])
+                       or str(allocator.allocate(prefix_length)))
+    return [tuple(spec) for spec in specs]
+
+
+def subnet_create(session, name_prefix=DEFAULT_NAME, subnet_cidrs=None,
+                  max_workers=DEFAULT_WORKERS, specs=None,
+                  per_az=DEFAULT_SUBNETS_PER_AZ,
+                  prefix_length=DEFAULT_SUBNET_PREFIX):
+    """Create the subnets missing from the VPC, spread across the zones
+
+    specs, as returned by subnet_specs(), picks the exact subnets to create
+    instead. The create calls are sent concurrently and all new subnets are
+    then waited on together.
+    """
+    client = get_client(session)
+    vpc_id = get_vpc_id(session, name_prefix)
+    if not vpc_id:
+        print(f'ERROR: VPC {name_prefix} not found, create it first.')
+        return
+    if specs is None:
+        azs = get_availability_zones(session)
+        print(f'AvailabilityZones: {azs}')
+        existing = list(paginate(session, 'describe_subnets', 'Subnets',
+                                 Filters=[{'Name': 'vpc-id',
+                                           'Values': [vpc_id]}]))
+        names = {name_tag(s) for s in existing}
+        try:
+            specs = [spec for spec in subnet_specs(
+                         azs, name_prefix, subnet_cidrs, per_az=per_az,
+                         prefix_length=prefix_length, existing=existing)
+                     if spec[0] not in names]
+        except ValueError as e:
+            print(f'ERROR: {e}')
+            return
+    if not specs:
+        print('Subnets already exist')
+        return
 
-    responses = []
-    for idx, az in enumerate(azs):
-        response = client.create_subnet(
+    def create(name, az, cidr):
+        return client.create_subnet(
             TagSpecifications=[{'ResourceType': 'subnet',
                                 'Tags': [{
                                     'Key': 'Name',
-                                    'Value': f'demo-{az}'
+                                    'Value': name
                                 }]}],
             AvailabilityZone=az,
-            CidrBlock=subnet_cidrs[idx],
-            VpcId=get_vpc_id(),
+            CidrBlock=cidr,
+            VpcId=vpc_id,
         )
 
-        if response:
-            responses.append(response)
+    with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+        responses = executor.map(lambda spec: create(*spec), specs)
+        responses = [response for response in responses if response]
 
     subnet_ids = []
     for response in responses:
         subnet_ids.append(response.get('Subnet', {}).get('SubnetId', None))
 
-    waiter = client.get_waiter('subnet_available')
-    waiter.wait(SubnetIds=subnet_ids)
+    wait_for(session, {'subnet': subnet_ids})
     print(f'Subnets created: {subnet_ids}')
 
+    state = get_state()
+    for response in responses:
+        subnet = response.get('Subnet', {})
+        name = next(t['Value'] for t in subnet.get('Tags', [])
+                    if t['Key'] == 'Name')
+        state.put('subnet', name, subnet.get('SubnetId'), subnet)
+
     write_output_json('subnets.json', responses)
 
 
@@ -283,26 +2345,24 @@ def igw(args):
         print('Internet Gateway')
         print(f'args: {args}')
 
-    session = boto3.session.Session(profile_name=args.profile,
-                                    region_name=args.region)
+    session = get_session(args.profile, args.region)
     if args.action == 'info':
-        igws = igw_info(session, name=args.name)
-        if igws:
-            print(json.dumps(igws))
+        igws = igw_info(session, name=args.name, stream=True)
+        print_ndjson(igws, fields=args.fields)
     elif args.action == 'create':
-        igws = igw_info(session, name=args.name)
-        if not igws:
-            igw_create(session)
+        if not resource_id(session, 'internet-gateway', args.name):
+            igw_create(session, name=args.name)
         else:
             print('Internet Gateway already exists')
     elif args.action == 'attach':
-        igw_attach(session)
+        igw_attach(session, name=args.name)
 
 
-def igw_info(session, name=DEFAULT_NAME):
+def igw_info(session, name=DEFAULT_NAME, stream=False):
     """"""
-    client = session.client('ec2')
-    response = client.describe_internet_gateways(
+    igws = describe(
+        session, 'describe_internet_gateways', 'internet-gateway',
+        'InternetGateways',
         Filters=[
             {
                 'Name': 'tag:Name',
@@ -312,12 +2372,12 @@ def igw_info(session, name=DEFAULT_NAME):
             },
         ],
     )
-    return response.get('InternetGateways', None)
+    return igws if stream else list(igws)
 
 
 def igw_create(session, name=DEFAULT_NAME):
     """"""
-    client = session.client('ec2')
+    client = get_client(session)
     response = client.create_internet_gateway(
         TagSpecifications=[
             {
@@ -331,28 +2391,29 @@ def igw_create(session, name=DEFAULT_NAME):
             },
         ],
     )
-    # boto3 is missing a waiter for internetgateway
     igw_id = response.get('InternetGateway', {}).get('InternetGatewayId')
+    wait_for(session, {'internet-gateway': [igw_id]})
     print(f'InternetGateway created: {igw_id}')
+    get_state().put('internet-gateway', name, igw_id,
+                    response.get('InternetGateway'))
 
     write_output_json('igw.json', response)
 
 
-def igw_attach(session, igw_id=None, vpc_id=None):
+def igw_attach(session, igw_id=None, vpc_id=None, name=DEFAULT_NAME):
     """Attach Internet Gateway to VPC"""
-    client = session.client('ec2')
+    client = get_client(session)
 
-    with open('outputs/igw.json', 'r') as fo:
-        data = json.load(fo)
-    igw_id = data.get('InternetGateway', {}).get('InternetGatewayId', None)
-    vpc_id = get_vpc_id()
+    igw_id = igw_id or resource_id(session, 'internet-gateway', name)
+    vpc_id = vpc_id or resource_id(session, 'vpc', name)
 
+    from botocore.exceptions import ClientError
     try:
         response = client.attach_internet_gateway(
             InternetGatewayId=igw_id,
             VpcId=vpc_id
         )
-    except botocore.exceptions.ClientError as e:
+    except ClientError as e:
         print(f'WARNING: Internet Gateway already attached: {e}')
         response = None
 
@@ -368,28 +2429,41 @@ def rt(args):
         print('Route Table')
         print(f'args: {args}')
 
-    session = boto3.session.Session(profile_name=args.profile,
-                                    region_name=args.region)
+    session = get_session(args.profile, args.region)
     if args.action == 'info':
-        route_tables = rt_info(session, name=args.name)
-        if route_tables:
-            print(json.dumps(route_tables))
+        route_tables = rt_info(session, name=args.name, stream=True)
+        print_ndjson(route_tables, fields=args.fields)
     elif args.action == 'create':
-        route_tables = rt_info(session)
-        if not route_tables:
-            rt_create(session)
+        if not resource_id(session, 'route-table', f'{args.name}-public',
+                           args.name):
+            rt_create(session, name=args.name)
         else:
-            print('Internet Gateway already exists')
+            print('Route table already exists')
     elif args.action == 'associate_subnet':
-        rt_associate_with_subnet(session)
+        rt_associate_with_subnet(session, name=args.name,
+                                 max_workers=args.workers)
     elif args.action == 'add_route':
-        route(session, dest_cidr='0.0.0.0/0')
-
-
-def rt_info(session, name=DEFAULT_NAME):
+        route(session, dest_cidr='0.0.0.0/0', name=args.name)
+    elif args.action == 'sync_routes':
+        try:
+            routes = read_routes(
+                args.routes_file,
+                igw_id=resource_id(session, 'internet-gateway', args.name))
+        except ValueError as e:
+            print(f'ERROR: {e}')
+            return False
+        result = rt_sync_routes(session, routes, name=args.name,
+                                max_workers=args.workers)
+        if not result:
+            return False
+        write_output_json('route_sync.json', result)
+        return not any(action.endswith(' failed') for action in result)
+
+
+def rt_info(session, name=DEFAULT_NAME, stream=False):
     """"""
-    client = session.client('ec2')
-    response = client.describe_route_tables(
+    route_tables = describe(
+        session, 'describe_route_tables', 'route-table', 'RouteTables',
         Filters=[
             {
                 'Name': 'tag:Name',
@@ -399,14 +2473,16 @@ def rt_info(session, name=DEFAULT_NAME):
             },
         ],
     )
-
-    return response.get('RouteTables', None)
+    return route_tables if stream else list(route_tables)
 
 
 def rt_create(session, name=DEFAULT_NAME):
     """"""
-    client = session.client('ec2')
-    vpc_id = get_vpc_id()
+    client = get_client(session)
+    vpc_id = get_vpc_id(session, name)
+    if not vpc_id:
+        print(f'ERROR: VPC {name} not found, create it first.')
+        return
 
     response = client.create_route_table(
         VpcId=vpc_id,
@@ -415,7 +2491,7 @@ def rt_create(session, name=DEFAULT_NAME):
                 'ResourceType': 'route-table',
                 'Tags': [
                     {
-                        'Key': 'tag:Name',
+                        'Key': 'Name',
                         'Value': f'{name}-public'
                     },
                 ]
@@ -424,35 +2500,47 @@ def rt_create(session, name=DEFAULT_NAME):
     )
     rt_id = response.get('RouteTable', {}).get('RouteTableId', None)
     print(f'Route table created: {rt_id}')
+    get_state().put('route-table', f'{name}-public', rt_id,
+                    response.get('RouteTable'))
 
     write_output_json('route_table.json', response)
 
 
-def rt_associate_with_subnet(session):
-    """"""
-    ec2 = session.resource('ec2')
+def stack_subnet_ids(session, name=DEFAULT_NAME):
+    """Ids of the stack's subnets, from state or the tag index"""
+    subnet_ids = get_state().ids('subnet', prefix=f'{name}-')
+    if not subnet_ids:
+        index = tag_index(session, name)
+        subnet_ids = [i for n in index.names('subnet')
+                      if n.startswith(f'{name}-')
+                      for i in index.ids('subnet', n)]
+    return subnet_ids
 
-    rt_data = read_output_json('route_table.json')
-    rt_id = rt_data.get('RouteTable', {}).get('RouteTableId', None)
-    route_table = ec2.RouteTable(rt_id)
 
-    sn_data = read_output_json('subnets.json')
-    sn_ids = [s.get('Subnet', {}).get('SubnetId', None) for s in sn_data]
+def rt_associate_with_subnet(session, name=DEFAULT_NAME, subnet_ids=None,
+                             max_workers=DEFAULT_WORKERS):
+    """Associate the stack's subnets, or subnet_ids, with its route table"""
+    client = get_client(session)
+    rt_id = resource_id(session, 'route-table', f'{name}-public', name)
+    subnet_ids = subnet_ids or stack_subnet_ids(session, name)
 
-    for sn_id in sn_ids:
-        rt_association = route_table.associate_with_subnet(SubnetId=sn_id)
-        print(f'Route Table association: {rt_association}')
+    def associate(subnet_id):
+        return client.associate_route_table(RouteTableId=rt_id,
+                                            SubnetId=subnet_id)
 
+    with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+        for response in executor.map(associate, subnet_ids):
+            print('Route Table association: '
+                  f'{response.get("AssociationId")}')
 
-def route(session, rt_id=None, dest_cidr=None):
-    """"""
-    client = session.client('ec2')
 
-    igw_data = read_output_json('igw.json')
-    igw_id = igw_data.get('InternetGateway', {}).get('InternetGatewayId', None)
+def route(session, rt_id=None, dest_cidr=None, name=DEFAULT_NAME):
+    """"""
+    client = get_client(session)
 
-    rt_data = read_output_json('route_table.json')
-    rt_id = rt_data.get('RouteTable', {}).get('RouteTableId', None)
+    igw_id = resource_id(session, 'internet-gateway', name)
+    rt_id = rt_id or resource_id(session, 'route-table', f'{name}-public',
+                                 name)
 
     response = client.create_route(DestinationCidrBlock=dest_cidr,
                                    GatewayId=igw_id,
@@ -461,83 +2549,396 @@ def route(session, rt_id=None, dest_cidr=None):
     write_output_json('route.json', response)
 
 
+# Route targets by id prefix, with the create_route parameter they go in
+_ROUTE_TARGETS = [
+    ('igw-', 'GatewayId'),
+    ('vgw-', 'GatewayId'),
+    ('nat-', 'NatGatewayId'),
+    ('pcx-', 'VpcPeeringConnectionId'),
+    ('tgw-', 'TransitGatewayId'),
+    ('i-', 'InstanceId'),
+    ('eni-', 'NetworkInterfaceId'),
+]
+
+
+def route_params(destination, target):
+    """create_route and replace_route parameters for a route"""
+    param = next((p for prefix, p in _ROUTE_TARGETS
+                  if target.startswith(prefix)), None)
+    if param is None:
+        raise ValueError(f'Unknown route target {target}')
+    if ':' in destination:
+        return {'DestinationIpv6CidrBlock': destination, param: target}
+    return {'DestinationCidrBlock': destination, param: target}
+
+
+def read_routes(path, igw_id=None):
+    """{destination: target} from a file with one CIDR TARGET per line
+
+    Targets are internet gateway, NAT gateway, peering connection, transit
+    gateway, instance or network interface ids, or "igw" for the stack's
+    internet gateway. Blank lines and anything after a # are ignored.
+    """
+    routes = {}
+    with open(path, 'r') as fo:
+        for number, line in enumerate(fo, 1):
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            try:
+                destination, target = fields
+                destination = str(ipaddress.ip_network(destination))
+                if target == 'igw':
+                    target = igw_id
+                route_params(destination, target or '')
+            except ValueError as e:
+                raise ValueError(f'{path}:{number}: expected CIDR TARGET: '
+                                 f'{e}') from None
+            routes[destination] = target
+    return routes
+
+
+def table_routes(route_table):
+    """{destination: target} of the routes made with create_route
+
+    The local route and propagated routes are left out.
+    """
+    routes = {}
+    for r in route_table.get('Routes', []):
+        if r.get('Origin') != 'CreateRoute':
+            continue
+        destination = (r.get('DestinationCidrBlock')
+                       or r.get('DestinationIpv6CidrBlock'))
+        target = next((r[p] for _, p in _ROUTE_TARGETS if r.get(p)), None)
+        if destination and target:
+            routes[destination] = target
+    return routes
+
+
+def route_changes(current, routes):
+    """[(action, destination, params)] turning current routes into routes
+
+    Both are {destination: target}. Missing routes are created, those
+    pointing elsewhere replaced and those not in routes deleted.
+    """
+    changes = []
+    for destination, target in sorted(routes.items()):
+        if destination not in current:
+            changes.append(('create', destination,
+                            route_params(destination, target)))
+        elif current[destination] != target:
+            changes.append(('replace', destination,
+                            route_params(destination, target)))
+    for destination in sorted(set(current) - set(routes)):
+        key = ('DestinationIpv6CidrBlock' if ':' in destination
+               else 'DestinationCidrBlock')
+        changes.append(('delete', destination, {key: destination}))
+    return changes
+
+
+def association_changes(route_table, associated, subnet_ids):
+    """[(action, subnet id, params)] associating subnets with route_table
+
+    associated are the route tables the subnets are associated with now.
+    Subnets associated with another table are moved over.
+    """
+    rt_id = route_table['RouteTableId']
+    other = {a['SubnetId']: a['RouteTableAssociationId']
+             for t in associated for a in t.get('Associations', [])
+             if a.get('SubnetId') and t['RouteTableId'] != rt_id}
+    mine = {a.get('SubnetId') for a in route_table.get('Associations', [])}
+    changes = []
+    for subnet_id in subnet_ids:
+        if subnet_id in mine:
+            continue
+        if subnet_id in other:
+            changes.append(('reassociate', subnet_id,
+                            {'AssociationId': other[subnet_id]}))
+        else:
+            changes.append(('associate', subnet_id, {'SubnetId': subnet_id}))
+    return changes
+
+
+def rt_sync_routes(session, routes, name=DEFAULT_NAME, subnet_ids=None,
+                   max_workers=DEFAULT_WORKERS):
+    """Make the route table's routes routes, and associate its subnets
+
+    The table and the subnets' current associations are read once, then
+    only the routes that are missing, point elsewhere or aren't wanted are
+    created, replaced or deleted, and subnets not yet associated with the
+    table are associated or moved over, up to max_workers calls at a time.
+    """
+    client = get_client(session)
+    rt_id = resource_id(session, 'route-table', f'{name}-public', name)
+    if not rt_id:
+        print(f'ERROR: Route table {name}-public not found, create it '
+              'first.')
+        return None
+    subnet_ids = subnet_ids or stack_subnet_ids(session, name)
+
+    def associated_tables():
+        tables = []
+        for start in range(0, len(subnet_ids), _FILTER_VALUES):
+            tables.extend(paginate(
+                session, 'describe_route_tables', 'RouteTables',
+                Filters=[{'Name': 'association.subnet-id',
+                          'Values': subnet_ids[start:start + _FILTER_VALUES]
+                          }]))
+        return tables
+
+    with ContextThreadPoolExecutor(max_workers=2) as executor:
+        table = executor.submit(client.describe_route_tables,
+                                RouteTableIds=[rt_id])
+        associated = executor.submit(associated_tables)
+        table = table.result()['RouteTables'][0]
+        associated = associated.result()
+
+    changes = (route_changes(table_routes(table), routes)
+               + association_changes(table, associated, subnet_ids))
+    funcs = {
+        'create': client.create_route,
+        'replace': client.replace_route,
+        'delete': client.delete_route,
+        'reassociate': client.replace_route_table_association,
+        'associate': client.associate_route_table,
+    }
+
+    def call(action, target, params):
+        funcs[action](RouteTableId=rt_id, **params)
+        return action, target
+
+    results = {}
+    with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(call, *c): c[:2] for c in changes}
+        for future in futures:
+            action, target = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f'ERROR: {action} {target}: {e}')
+                action = f'{action} failed'
+            results.setdefault(action, []).append(target)
+
+    counts = ', '.join(f'{len(v)} {k}' for k, v in sorted(results.items()))
+    print(f'Route table {rt_id}: {counts or "up to date"}')
+    return {'RouteTableId': rt_id, **results}
+
+
 def security_group(args):
     """Security Group"""
     if args.debug:
         print('Security Group')
         print(f'args: {args}')
 
-    session = boto3.session.Session(profile_name=args.profile,
-                                    region_name=args.region)
+    session = get_session(args.profile, args.region)
 
     if args.action == 'info':
-        sec_groups = security_group_info(session, name=args.name)
-        if sec_groups:
-            print(json.dumps(sec_groups))
+        sec_groups = security_group_info(session, name=args.name,
+                                         stream=True)
+        print_ndjson(sec_groups, fields=args.fields)
     elif args.action == 'create':
-        sec_groups = security_group_info(session, name=args.name)
-        if not sec_groups:
-            security_group_create(session)
+        if not resource_id(session, 'security-group', args.name):
+            security_group_create(session, name=args.name)
         else:
             print('Security Group already exists')
-
-
-def security_group_info(session, name=DEFAULT_NAME):
+    elif args.action == 'apply_rules':
+        if not args.rules_file:
+            print('ERROR: apply_rules needs --rules_file')
+            return
+        try:
+            rules = read_rules(args.rules_file)
+        except ValueError as e:
+            print(f'ERROR: {e}')
+            return
+        result = sg_apply_rules(session, rules, name=args.name,
+                                batch_size=args.batch_size)
+        if result:
+            write_output_json('security_group_rules.json', result)
+
+
+def security_group_info(session, name=DEFAULT_NAME, stream=False):
     """"""
+    filters = [{'Name': 'group-name', 'Values': [name]}]
+    vpc_id = get_vpc_id(session, name)
+    if vpc_id:
+        filters.append({'Name': 'vpc-id', 'Values': [vpc_id]})
+    groups = describe(session, 'describe_security_groups', 'security-group',
+                      'SecurityGroups', Filters=filters)
+    return groups if stream else list(groups)
 
 
 def security_group_create(session, name=DEFAULT_NAME):
     """"""
-    client = session.client('ec2')
+    client = get_client(session)
+    from botocore.exceptions import ClientError
     try:
         response = client.create_security_group(
             Description=name,
             GroupName=name,
-            VpcId=get_vpc_id(),
+            VpcId=get_vpc_id(session, name),
             TagSpecifications=[
                 {
                     'ResourceType': 'security-group',
                     'Tags': [
                         {
-                            'Key': 'tag:Name',
+                            'Key': 'Name',
                             'Value': name
                         },
                     ]
                 },
             ],
         )
-    except botocore.exceptions.ClientError as e:
+    except ClientError as e:
         print(f'ERROR: Security group already exists: {e}')
         return
 
     group_id = response.get('GroupId', None)
 
-    waiter = client.get_waiter('security_group_exists')
-    waiter.wait(
-        GroupIds=[
-            group_id,
-        ],
-    )
+    wait_for(session, {'security-group': [group_id]})
 
     print(f'Created security group: {group_id}')
+    get_state().put('security-group', name, group_id)
     write_output_json('security_group.json', response)
 
 
-def sg_ingress_rule(session, cidr=None):
-    """"""
-    sg_data = read_output_json('security_group.json')
-    sg_id = sg_data.get('GroupId', None)
-
-    ec2_resource = session.resource('ec2')
-    sg = ec2_resource.SecurityGroup(sg_id)
-
-    response = sg.authorize_ingress(
-        CidrIp=cidr,
-        FromPort=22,
-        GroupName='demo-ssh',
-        IpProtocol='tcp',
-        ToPort=22,
-    )
+def sg_ingress_rule(session, cidr=None, name=DEFAULT_NAME, protocol='tcp',
+                    port=22):
+    """Allow one port from cidr into the security group"""
+    group_id = get_security_group_id(session, name)
+    get_client(session).authorize_security_group_ingress(
+        GroupId=group_id,
+        IpPermissions=ip_permissions([rule_key(protocol, port, port, cidr)]))
+
+
+# Protocol numbers EC2 reports by name
+_PROTOCOL_NAMES = {'1': 'icmp', '6': 'tcp', '17': 'udp', '58': 'icmpv6',
+                   'all': '-1'}
+_ICMP_PROTOCOLS = ('icmp', 'icmpv6')
+
+
+def protocol_name(protocol):
+    """EC2's name for a protocol name or number, '-1' for all"""
+    protocol = str(protocol).lower()
+    return _PROTOCOL_NAMES.get(protocol, protocol)
+
+
+def rule_key(protocol, from_port, to_port, cidr):
+    """(protocol, from port, to port, cidr) identifying an ingress rule
+
+    For ICMP the ports are the ICMP type and code, -1 when missing so any
+    type or code matches. Protocols other than TCP, UDP and ICMP have none.
+    """
+    protocol = protocol_name(protocol)
+    if protocol in _ICMP_PROTOCOLS:
+        from_port, to_port = (-1 if port in (None, '') else int(port)
+                              for port in (from_port, to_port))
+    elif protocol in ('tcp', 'udp'):
+        from_port, to_port = int(from_port), int(to_port)
+    else:
+        from_port = to_port = None
+    return (protocol, from_port, to_port, str(ipaddress.ip_network(cidr)))
+
+
+def read_rules(path):
+    """Ingress rules from a file with one PROTOCOL PORTS CIDR per line
+
+    PORTS is PORT[-PORT] for TCP and UDP and TYPE[/CODE] for ICMP, where
+    a missing type or code means any. Protocols without ports, such as
+    "all" for every protocol, take "-" or nothing in its place, as does
+    ICMP for every type. Blank lines and anything after a # are ignored.
+    """
+    rules = set()
+    with open(path, 'r') as fo:
+        for number, line in enumerate(fo, 1):
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            try:
+                if len(fields) == 2:
+                    fields.insert(1, '-')
+                protocol, ports, cidr = fields
+                ports = '' if ports == '-' else ports
+                if protocol_name(protocol) in _ICMP_PROTOCOLS:
+                    from_port, _, to_port = ports.partition('/')
+                else:
+                    from_port, _, to_port = ports.partition('-')
+                    to_port = to_port or from_port
+                rules.add(rule_key(protocol, from_port, to_port, cidr))
+            except ValueError as e:
+                raise ValueError(f'{path}:{number}: expected PROTOCOL '
+                                 f'PORTS CIDR: {e}') from None
+    return rules
+
+
+def ingress_rules(permissions):
+    """Rules in a security group's IpPermissions, one per CIDR"""
+    rules = set()
+    for permission in permissions:
+        cidrs = ([r['CidrIp'] for r in permission.get('IpRanges', [])]
+                 + [r['CidrIpv6'] for r in permission.get('Ipv6Ranges', [])])
+        for cidr in cidrs:
+            rules.add(rule_key(permission['IpProtocol'],
+                               permission.get('FromPort'),
+                               permission.get('ToPort'), cidr))
+    return rules
+
+
+def ip_permissions(rules):
+    """IpPermissions for rules, one entry per protocol and port range"""
+    permissions = {}
+    for protocol, from_port, to_port, cidr in sorted(rules, key=str):
+        permission = permissions.get((protocol, from_port, to_port))
+        if permission is None:
+            permission = {'IpProtocol': protocol, 'IpRanges': [],
+                          'Ipv6Ranges': []}
+            if from_port is not None:
+                permission.update(FromPort=from_port, ToPort=to_port)
+            permissions[(protocol, from_port, to_port)] = permission
+        if ':' in cidr:
+            permission['Ipv6Ranges'].append({'CidrIpv6': cidr})
+        else:
+            permission['IpRanges'].append({'CidrIp': cidr})
+    return list(permissions.values())
+
+
+def get_security_group_id(session, name=DEFAULT_NAME):
+    """Id of the named security group, from state or the tag index"""
+    return resource_id(session, 'security-group', name)
+
+
+def sg_apply_rules(session, rules, name=DEFAULT_NAME,
+                   batch_size=DEFAULT_RULE_BATCH):
+    """Make the security group's CIDR ingress rules exactly rules
+
+    Reads the group's permissions once and only revokes and authorizes the
+    difference, up to batch_size rules per call. Rules referencing other
+    groups or prefix lists are left alone.
+    """
+    group_id = get_security_group_id(session, name)
+    if not group_id:
+        print(f'ERROR: Security group {name} not found, create it first.')
+        return None
+
+    client = get_client(session)
+    group = client.describe_security_groups(
+        GroupIds=[group_id])['SecurityGroups'][0]
+    current = ingress_rules(group.get('IpPermissions', []))
+    revoke = sorted(current - rules, key=str)
+    add = sorted(rules - current, key=str)
+
+    # Revoke first, so the group stays under its rule quota
+    for start in range(0, len(revoke), batch_size):
+        client.revoke_security_group_ingress(
+            GroupId=group_id,
+            IpPermissions=ip_permissions(revoke[start:start + batch_size]))
+    for start in range(0, len(add), batch_size):
+        client.authorize_security_group_ingress(
+            GroupId=group_id,
+            IpPermissions=ip_permissions(add[start:start + batch_size]))
+
+    print(f'Security group {group_id}: {len(add)} rules added, '
+          f'{len(revoke)} revoked, {len(current & rules)} unchanged')
+    return {'GroupId': group_id, 'added': add, 'revoked': revoke}
 
 
 def ec2(args):
@@ -546,21 +2947,40 @@ def ec2(args):
         print('EC2')
         print(f'args: {args}')
 
-    session = boto3.session.Session(profile_name=args.profile,
-                                    region_name=args.region)
+    session = get_session(args.profile, args.region)
+    launch = dict(ami=args.ami, ami_name=args.ami_name,
+                  ami_owner=args.ami_owner, chunk_size=args.chunk_size,
+                  max_workers=args.workers)
 
     if args.action == 'info':
-        ec2s = ec2_info(session, vpc_name=args.name)
-        if ec2s:
-            print(json.dumps(ec2s))
+        ec2s = ec2_info(session, name=args.name, stream=True)
+        print_ndjson(ec2s, fields=args.fields)
     elif args.action == 'create':
-        ec2s = vpc_info(session, vpc_name=args.name)
-        if not ec2s:
-            ec2_create(session)
+        ec2s = ec2_info(session, name=args.name,
+                        states=['pending', 'running'])
+        if len(ec2s) < args.count:
+            ec2_create(session, name=args.name, count=args.count - len(ec2s),
+                       **launch)
         else:
-            print('VPC already exists')
+            print('Instances already exist:',
+                  [x.get('InstanceId', None) for x in ec2s])
     elif args.action == 'import_ssh_key':
         ec2_import_ssh_key(session)
+    elif args.action == 'pool':
+        pool_fill(session, name=args.name, size=args.count, **launch)
+    elif args.action == 'acquire':
+        instance_ids, available = pool_acquire(
+            session, name=args.name, count=args.count, **launch)
+        write_output_json('ec2_instance.json', instance_ids)
+        size = available if args.pool_size is None else args.pool_size
+        if size > 0:
+            pid, log = pool_backfill(args, size)
+            print(f'Backfilling pool {args.name} to {size} instances in '
+                  f'process {pid}, output in {log}')
+    elif args.action == 'release':
+        instance_ids = [i.strip() for i in (args.instance_ids or '').split(',')
+                        if i.strip()]
+        pool_release(session, name=args.name, instance_ids=instance_ids)
 
 
 def ec2_import_ssh_key(session, name=DEFAULT_NAME, keyname='aws-sydney-demo'):
@@ -577,7 +2997,8 @@ def ec2_import_ssh_key(session, name=DEFAULT_NAME, keyname='aws-sydney-demo'):
 
     security_group
 
-    client = session.client('ec2')
+    client = get_client(session)
+    from botocore.exceptions import ClientError
     try:
         response = client.import_key_pair(
             KeyName=keyname,
@@ -594,99 +3015,952 @@ def ec2_import_ssh_key(session, name=DEFAULT_NAME, keyname='aws-sydney-demo'):
                 },
             ]
         )
+        get_state().put('key-pair', keyname, response.get('KeyPairId'))
         write_output_json('ssh_key_pair.json', response)
-    except botocore.exceptions.ClientError as e:
+    except ClientError as e:
         print(f'ERROR: Key import failed: {e}')
 
 
-def ec2_info(session):
-    """"""
+def ec2_info(session, name=DEFAULT_NAME, states=None, stream=False):
+    """Instances with the Name tag, optionally only those in states"""
+    filters = [{'Name': 'tag:Name', 'Values': [name]}]
+    if states:
+        filters.append({'Name': 'instance-state-name', 'Values': states})
+    instances = describe(session, 'describe_instances', 'instance',
+                         'Reservations', Filters=filters)
+    return instances if stream else list(instances)
+
+
+def fleet_chunks(subnet_ids, count, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Split count instances evenly over subnets, in chunks of chunk_size
+
+    Returns [(subnet_id, instances)], one entry per launch call.
+    """
+    if chunk_size < 1:
+        raise ValueError(f'chunk_size must be at least 1, not {chunk_size}')
+    chunks = []
+    per_subnet, extra = divmod(count, len(subnet_ids))
+    for idx, subnet_id in enumerate(subnet_ids):
+        remaining = per_subnet + (1 if idx < extra else 0)
+        while remaining > 0:
+            chunk = min(remaining, chunk_size)
+            chunks.append((subnet_id, chunk))
+            remaining -= chunk
+    return chunks
+
+
+def launch_instances(session, ami=None, name=DEFAULT_NAME,
+                     instance_type='t3a.nano', ssh_key='aws-sydney-demo',
+                     count=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                     max_workers=DEFAULT_WORKERS, tags=None,
+                     ami_name=DEFAULT_AMI_NAME, ami_owner=DEFAULT_AMI_OWNER):
+    """Launch count instances spread across the stack's subnets
+
+    Each launch call asks for up to chunk_size instances in one subnet and
+    the calls run concurrently. tags are added to the Name tag. Without
+    ami the newest image matching ami_name and ami_owner is used. Returns
+    the instance ids without waiting for them.
+    """
+    subnet_ids = stack_subnet_ids(session, name)
+    if not subnet_ids:
+        print(f'ERROR: No subnets found for {name}, create them first.')
+        return []
+    group_id = get_security_group_id(session, name)
+    ami = ami or latest_ami(session, ami_name, ami_owner)
+    instance_tags = [{'Key': 'Name', 'Value': name}]
+    instance_tags += [{'Key': k, 'Value': v} for k, v in (tags or {}).items()]
+
+    def launch(subnet_id, chunk):
+        params = {}
+        if group_id:
+            params['SecurityGroupIds'] = [group_id]
+        instances = get_resource(session).create_instances(
+            ImageId=ami,
+            InstanceType=instance_type,
+            KeyName=ssh_key,
+            MinCount=chunk,
+            MaxCount=chunk,
+            SubnetId=subnet_id,
+            TagSpecifications=[
+                {
+                    'ResourceType': 'instance',
+                    'Tags': instance_tags,
+                },
+            ],
+            **params,
+        )
+        return [i.id for i in instances]
 
+    chunks = fleet_chunks(subnet_ids, count, chunk_size)
+    with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+        launched = executor.map(lambda c: launch(*c), chunks)
+        return [i for ids in launched for i in ids]
 
-def ec2_create(session, ami='ami-06ce513624b435a22', name=DEFAULT_NAME,
-               instance_type='t3a.nano', ssh_key='aws-sydney-demo'):
-    """"""
-    ec2_client = session.client('ec2')
-    ec2_resource = session.resource('ec2')
-
-    instance = ec2_resource.create_instances(
-        ImageId=ami,
-        InstanceType=instance_type,
-        KeyName=ssh_key,
-        # SecurityGroupIds=[
-        #     'string',
-        # ],
-
-        SubnetId='subnet-00f32a2732637f530',
-        # NetworkInterfaces=[
-        #     {
-        #         'AssociatePublicIpAddress': True | False,
-        #         'DeleteOnTermination': True | False,
-        #         'Description': 'string',
-        #         'DeviceIndex': 123,
-        #         'Groups': [
-        #             'string',
-        #         ],
-        #         'Ipv6AddressCount': 123,
-        #         'Ipv6Addresses': [
-        #             {
-        #                 'Ipv6Address': 'string'
-        #             },
-        #         ],
-        #         'NetworkInterfaceId': 'string',
-        #         'PrivateIpAddress': 'string',
-        #         'PrivateIpAddresses': [
-        #             {
-        #                 'Primary': True | False,
-        #                 'PrivateIpAddress': 'string'
-        #             },
-        #         ],
-        #         'SecondaryPrivateIpAddressCount': 123,
-        #         'SubnetId': 'string',
-        #         'AssociateCarrierIpAddress': True | False,
-        #         'InterfaceType': 'string',
-        #         'NetworkCardIndex': 123
-        #     },
-        # ],
-        TagSpecifications=[
-            {
-                'ResourceType': 'instance',
-                'Tags': [
-                    {
-                        'Key': 'Name',
-                        'Value': name
-                    },
-                ]
-            },
-        ],
-    )
 
-    waiter = ec2_client.get_waiter('instance_running')
-    waiter.wait(
-        Filters=[
-            {
-                'Name': 'instance-id',
-                'Values': [
-                    'string',
-                ]
-            },
-        ],
-        InstanceIds=[
-            'string',
-        ],
-        DryRun=True | False,
-        MaxResults=123,
-        NextToken='string',
-        WaiterConfig={
-            'Delay': 123,
-            'MaxAttempts': 123
+def ec2_create(session, name=DEFAULT_NAME, count=1, **kwargs):
+    """Launch count instances and wait for the whole fleet to run
+
+    Takes the options of launch_instances().
+    """
+    instance_ids = launch_instances(session, name=name, count=count,
+                                    **kwargs)
+    if not instance_ids:
+        return
+
+    wait_for(session, {'instance': instance_ids})
+    print(f'Instances running: {instance_ids}')
+
+    write_output_json('ec2_instance.json', instance_ids)
+
+
+# Tag marking instances of a stack's warm pool, 'available' while they wait
+# stopped in the pool and 'acquired' while in use
+POOL_TAG = 'Pool'
+# Tag with the id of the acquire that took an instance from the pool
+POOL_CLAIM_TAG = 'PoolClaim'
+
+
+def pool_instances(session, name=DEFAULT_NAME, status='available',
+                   states=('pending', 'running', 'stopping', 'stopped')):
+    """Ids of the stack's pool instances with a status, in states"""
+    return [i['InstanceId'] for i in paginate(
+        session, 'describe_instances', 'Reservations', Filters=[
+            {'Name': 'tag:Name', 'Values': [name]},
+            {'Name': f'tag:{POOL_TAG}', 'Values': [status]},
+            {'Name': 'instance-state-name', 'Values': list(states)},
+        ])]
+
+
+def _batches(ids, size=_FILTER_VALUES):
+    return [ids[i:i + size] for i in range(0, len(ids), size)]
+
+
+def set_pool_status(session, instance_ids, status):
+    """Tag instances as available in, or acquired from, the pool"""
+    client = get_client(session)
+    for batch in _batches(instance_ids):
+        client.create_tags(Resources=batch,
+                           Tags=[{'Key': POOL_TAG, 'Value': status}])
+
+
+def stop_instances(session, instance_ids):
+    """Stop instances and wait until they have"""
+    client = get_client(session)
+    for batch in _batches(instance_ids):
+        client.stop_instances(InstanceIds=batch)
+    wait_for(session, {'instance': instance_ids},
+             states={'instance': 'stopped'})
+
+
+def pool_fill(session, name=DEFAULT_NAME, size=1, **kwargs):
+    """Launch and stop instances until the pool has size available
+
+    Takes the options of launch_instances(). Available instances left
+    running, e.g. by an interrupted fill, are stopped.
+    """
+    running = pool_instances(session, name, states=('pending', 'running'))
+    available = pool_instances(session, name)
+    launched = []
+    if len(available) < size:
+        launched = launch_instances(session, name=name,
+                                    count=size - len(available),
+                                    tags={POOL_TAG: 'available'}, **kwargs)
+        wait_for(session, {'instance': launched})
+    if running + launched:
+        stop_instances(session, running + launched)
+    print(f'Pool {name}: {len(available) + len(launched)} instances '
+          f'available, {len(launched)} launched')
+    return launched
+
+
+def pool_claim(session, name=DEFAULT_NAME, count=1):
+    """Tag up to count available pool instances as acquired by this call
+
+    The instances are tagged with a claim id of their own and read back,
+    those another acquire tagged since are left to it. Acquires sharing the
+    outputs directory take turns. Returns the claimed instance ids and how
+    many instances the pool had available.
+    """
+    claim = os.urandom(8).hex()
+    client = get_client(session)
+    with file_lock(output_dir() / 'pool'):
+        stopped = pool_instances(session, name, states=('stopped',))
+        candidates = stopped[:count]
+        for batch in _batches(candidates):
+            client.create_tags(Resources=batch, Tags=[
+                {'Key': POOL_TAG, 'Value': 'acquired'},
+                {'Key': POOL_CLAIM_TAG, 'Value': claim},
+            ])
+        claims = {}
+        for batch in _batches(candidates):
+            for instance in paginate(session, 'describe_instances',
+                                     'Reservations', InstanceIds=batch):
+                claims[instance['InstanceId']] = next(
+                    (t['Value'] for t in instance.get('Tags', [])
+                     if t['Key'] == POOL_CLAIM_TAG), claim)
+    taken = [i for i in candidates if claims.get(i, claim) == claim]
+    return taken, len(stopped)
+
+
+def pool_acquire(session, name=DEFAULT_NAME, count=1, **kwargs):
+    """Start count pooled instances, launching any the pool is short of
+
+    Takes the options of launch_instances(). Returns the instance ids and
+    how many instances the pool had available. Instances that fail to start
+    go back to the pool.
+    """
+    taken, available = pool_claim(session, name, count)
+    if taken:
+        client = get_client(session)
+        try:
+            for batch in _batches(taken):
+                client.start_instances(InstanceIds=batch)
+        except Exception:
+            # pool_fill() stops any of them that did start
+            set_pool_status(session, taken, 'available')
+            raise
+    launched = []
+    if len(taken) < count:
+        launched = launch_instances(session, name=name,
+                                    count=count - len(taken),
+                                    tags={POOL_TAG: 'acquired'}, **kwargs)
+    wait_for(session, {'instance': taken + launched})
+    print(f'Instances running: {taken + launched} ({len(taken)} from the '
+          f'pool, {len(launched)} launched)')
+    return taken + launched, available
+
+
+def pool_release(session, name=DEFAULT_NAME, instance_ids=None):
+    """Stop instances and return them to the pool, all acquired by default"""
+    instance_ids = instance_ids or pool_instances(
+        session, name, status='acquired', states=('pending', 'running'))
+    if not instance_ids:
+        print(f'Pool {name}: no instances to release')
+        return
+    stop_instances(session, instance_ids)
+    set_pool_status(session, instance_ids, 'available')
+    print(f'Pool {name}: released {instance_ids}')
+
+
+def pool_backfill(args, size):
+    """Fill the pool to size in a detached ec2 --action pool process
+
+    The process outlives the command, and the serve daemon's request, and
+    appends its output to outputs/<region>/pool_backfill.log. Returns its
+    pid and the log's path.
+    """
+    argv = [sys.executable, str(Path(__file__).resolve()),
+            '--profile', args.profile, '--region', args.region,
+            '--max_attempts', str(args.max_attempts),
+            'ec2', '--action', 'pool', '--name', args.name,
+            '--count', str(size), '--chunk_size', str(args.chunk_size),
+            '--workers', str(args.workers), '--ami_name', args.ami_name,
+            '--ami_owner', args.ami_owner]
+    if args.ami:
+        argv += ['--ami', args.ami]
+    # Run it here rather than in a serve daemon $CLI_SOCKET points at
+    env = {k: v for k, v in os.environ.items() if k != 'CLI_SOCKET'}
+    log = output_dir() / 'pool_backfill.log'
+    log.parent.mkdir(parents=True, exist_ok=True)
+    with open(log, 'a') as fo:
+        process = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=fo,
+                                   stderr=subprocess.STDOUT, env=env,
+                                   start_new_session=True)
+    return process.pid, log
+
+
+def name_tag(resource):
+    """Value of the resource's Name tag, or None"""
+    return next((t['Value'] for t in resource.get('Tags', [])
+                 if t['Key'] == 'Name'), None)
+
+
+def resolve(value):
+    """Id for a '<resource-type name>' placeholder of a planned resource"""
+    if isinstance(value, str) and value.startswith('<'):
+        resource_type, name = value[1:-1].split(' ', 1)
+        return get_state().get_id(resource_type, name)
+    return value
+
+
+def stack_plan(session, name=DEFAULT_NAME, subnet_cidrs=None):
+    """API calls needed to bring the stack to its desired state
+
+    The current state is read with one concurrent set of describes. What
+    already exists is recorded in the state store, and {step: [calls]} is
+    returned for the rest, each call {'call': operation, 'params': {...}}.
+    Ids of resources that are still to be created appear as
+    '<resource-type name>' placeholders, see resolve().
+    """
+    known_vpc_id = get_vpc_id(session, name)
+    with ContextThreadPoolExecutor(max_workers=2) as executor:
+        azs = executor.submit(get_availability_zones, session)
+        resources = executor.submit(inventory_fetch, session, name)
+        azs, resources = azs.result(), resources.result()
+    vpc = next((v for v in resources['vpc']
+                if v.get('CidrBlock') == DEFAULT_CIDR), None)
+    if vpc and known_vpc_id and vpc['VpcId'] != known_vpc_id:
+        resources = inventory_fetch(session, name, vpc_ids=[vpc['VpcId']])
+
+    plan = {}
+    found = []
+
+    def add(step, call, **params):
+        plan.setdefault(step, []).append({'call': call, 'params': params})
+
+    def in_vpc(resource_type):
+        return [r for r in resources[resource_type]
+                if vpc and r.get('VpcId') == vpc['VpcId']]
+
+    if vpc:
+        vpc_id = vpc['VpcId']
+        found.append(('vpc', name, vpc_id, vpc))
+    else:
+        vpc_id = f'<vpc {name}>'
+        add('vpc_create', 'create_vpc', CidrBlock=DEFAULT_CIDR, Name=name)
+
+    subnets = {name_tag(s): s for s in in_vpc('subnet')}
+    subnet_ids = []
+    for subnet_name, az, cidr in subnet_specs(azs, name, subnet_cidrs,
+                                              existing=in_vpc('subnet')):
+        if subnet_name in subnets:
+            subnet = subnets[subnet_name]
+            found.append(('subnet', subnet_name, subnet['SubnetId'], subnet))
+            subnet_ids.append(subnet['SubnetId'])
+        else:
+            add('subnet_create', 'create_subnet', VpcId=vpc_id,
+                CidrBlock=cidr, AvailabilityZone=az, Name=subnet_name)
+            subnet_ids.append(f'<subnet {subnet_name}>')
+
+    igw = next(iter(resources['internet-gateway']), None)
+    if igw:
+        igw_id = igw['InternetGatewayId']
+        found.append(('internet-gateway', name, igw_id, igw))
+    else:
+        igw_id = f'<internet-gateway {name}>'
+        add('igw_create', 'create_internet_gateway', Name=name)
+    if not igw or vpc_id not in [a.get('VpcId')
+                                 for a in igw.get('Attachments', [])]:
+        add('igw_attach', 'attach_internet_gateway',
+            InternetGatewayId=igw_id, VpcId=vpc_id)
+
+    rt_name = f'{name}-public'
+    route_table = next((r for r in in_vpc('route-table')
+                        if name_tag(r) == rt_name), None)
+    if route_table:
+        rt_id = route_table['RouteTableId']
+        found.append(('route-table', rt_name, rt_id, route_table))
+    else:
+        rt_id = f'<route-table {rt_name}>'
+        add('rt_create', 'create_route_table', VpcId=vpc_id, Name=rt_name)
+    route_table = route_table or {}
+    associated = {a.get('SubnetId')
+                  for a in route_table.get('Associations', [])}
+    for subnet_id in subnet_ids:
+        if subnet_id not in associated:
+            add('rt_associate_with_subnet', 'associate_route_table',
+                RouteTableId=rt_id, SubnetId=subnet_id)
+    if not any(r.get('DestinationCidrBlock') == '0.0.0.0/0'
+               and r.get('GatewayId') == igw_id
+               for r in route_table.get('Routes', [])):
+        add('route', 'create_route', RouteTableId=rt_id,
+            DestinationCidrBlock='0.0.0.0/0', GatewayId=igw_id)
+
+    group = next((g for g in in_vpc('security-group')
+                  if g.get('GroupName') == name), None)
+    if group:
+        found.append(('security-group', name, group['GroupId'], group))
+    else:
+        add('security_group_create', 'create_security_group',
+            GroupName=name, VpcId=vpc_id)
+
+    get_state().put_many(found)
+    return plan
+
+
+def print_plan(plan):
+    """Print planned calls, one per line, in provisioning order"""
+    for step in apply_steps():
+        for call in plan.get(step, []):
+            params = ' '.join(f'{k}={v}' for k, v in call['params'].items())
+            print(f'{step}: {call["call"]} {params}')
+
+
+def apply_steps(name=DEFAULT_NAME, plan=None):
+    """Provisioning steps as {step: (callable, dependencies)}
+
+    Steps that create several resources only create the ones in plan.
+    """
+    plan = plan or {}
+
+    def planned(step):
+        return [call['params'] for call in plan.get(step, [])]
+
+    def subnet_step(session):
+        specs = [(p['Name'], p['AvailabilityZone'], p['CidrBlock'])
+                 for p in planned('subnet_create')]
+        subnet_create(session, name_prefix=name, specs=specs or None)
+
+    def associate_step(session):
+        subnet_ids = [resolve(p['SubnetId'])
+                      for p in planned('rt_associate_with_subnet')]
+        rt_associate_with_subnet(session, name=name, subnet_ids=subnet_ids)
+
+    return {
+        'vpc_create': (
+            lambda session: vpc_create(
+                session, tags=[{'Key': 'Name', 'Value': name}]),
+            []),
+        'subnet_create': (subnet_step, ['vpc_create']),
+        'igw_create': (lambda session: igw_create(session, name=name), []),
+        'igw_attach': (lambda session: igw_attach(session, name=name),
+                       ['vpc_create', 'igw_create']),
+        'rt_create': (lambda session: rt_create(session, name=name),
+                      ['vpc_create']),
+        'rt_associate_with_subnet': (associate_step,
+                                     ['rt_create', 'subnet_create']),
+        'route': (
+            lambda session: route(session, dest_cidr='0.0.0.0/0', name=name),
+            ['rt_create', 'igw_attach']),
+        'security_group_create': (
+            lambda session: security_group_create(session, name=name),
+            ['vpc_create']),
+    }
+
+
+def run_dag(steps, run_step, max_workers=DEFAULT_WORKERS):
+    """Run {step: (callable, dependencies)} with independent steps in parallel
+
+    run_step(name, callable) is called from a worker thread once every
+    dependency of the step has finished. Dependencies that are not part of
+    steps are treated as already satisfied. After a failure no new steps are
+    started; the ones already running are allowed to finish and the first
+    error is raised.
+    """
+    pending = dict(steps)
+    done = set()
+    running = {}
+    error = None
+
+    with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+        while running or (pending and error is None):
+            if error is None:
+                for name, (func, deps) in list(pending.items()):
+                    if all(d in done or d not in steps for d in deps):
+                        future = executor.submit(run_step, name, func)
+                        running[future] = name
+                        del pending[name]
+
+            if not running:
+                raise RuntimeError(
+                    f'Unresolvable step dependencies: {sorted(pending)}')
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f'ERROR: {name} failed: {e}')
+                    if error is None:
+                        error = e
+                else:
+                    done.add(name)
+
+    if error is not None:
+        raise error
+    return done
+
+
+def apply(args):
+    """Provision the whole stack as a dependency graph in one process"""
+    if args.debug:
+        print('Apply')
+        print(f'args: {args}')
+
+    session = get_session(args.profile, args.region)
+    start = time.perf_counter()
+    plan = stack_plan(session, args.name)
+    if not plan:
+        print(f'Stack {args.name} is up to date')
+        return
+    run = get_journal().start(args.name, plan)
+    run_journaled(session, run, max_workers=args.workers)
+    print(f'Stack {args.name} applied in {time.perf_counter() - start:.1f}s')
+
+
+def run_journaled(session, run, max_workers=DEFAULT_WORKERS):
+    """Run the steps of a journaled apply that haven't finished yet
+
+    Mutations already logged as done in the run are answered from the
+    journal rather than sent again.
+    """
+    steps = {step: value
+             for step, value in apply_steps(run.name, run.plan).items()
+             if step in run.plan and step not in run.steps_done}
+
+    def run_step(name, func):
+        start = time.perf_counter()
+        _journal_step.set(name)
+        with trace_span(name, 'step'):
+            func(session)
+        run.log('step', step=name)
+        print(f'Step {name} done in {time.perf_counter() - start:.1f}s')
+
+    token = _journal_run.set(run)
+    try:
+        run_dag(steps, run_step, max_workers=max_workers)
+    except Exception as e:
+        run.log('failed', error=str(e))
+        print(f'Continue with: cli.py --region {session.region_name} '
+              f'resume --name {run.name}')
+        raise
+    finally:
+        _journal_run.reset(token)
+    run.log('finished')
+
+
+def resume(args):
+    """Continue the last apply of a stack from where it stopped"""
+    if args.debug:
+        print('Resume')
+        print(f'args: {args}')
+
+    session = get_session(args.profile, args.region)
+    run = get_journal().last_run(args.name)
+    if run is None:
+        print(f'No apply of stack {args.name} to resume')
+        return
+    if run.finished:
+        print(f'The last apply of stack {args.name} finished')
+        return
+    start = time.perf_counter()
+    print(f'Resuming {run.id}, steps done: {sorted(run.steps_done)}')
+    run_journaled(session, run, max_workers=args.workers)
+    print(f'Stack {args.name} applied in {time.perf_counter() - start:.1f}s')
+
+
+def plan(args):
+    """Show the API calls apply would make"""
+    if args.debug:
+        print('Plan')
+        print(f'args: {args}')
+
+    session = get_session(args.profile, args.region)
+    stack = stack_plan(session, args.name)
+    if stack:
+        print_plan(stack)
+    else:
+        print(f'Stack {args.name} is up to date')
+
+
+def inventory_fetch(session, name=DEFAULT_NAME, vpc_ids=None):
+    """Describe a stack's resources with concurrent calls
+
+    Returns {resource type: [resources]}. All describes go out at the same
+    time when the VPC ids are known, from the state store or the tag index
+    by default; otherwise the VPCs are looked up by Name tag first.
+    """
+    if vpc_ids is None:
+        vpc_id = get_vpc_id(session, name)
+        vpc_ids = [vpc_id] if vpc_id else None
+
+    def vpc_calls(vpc_ids):
+        vpc_filter = [{'Name': 'vpc-id', 'Values': vpc_ids}]
+        return {
+            'subnet': lambda: paginate(session, 'describe_subnets',
+                                       'Subnets', Filters=vpc_filter),
+            'route-table': lambda: paginate(session, 'describe_route_tables',
+                                            'RouteTables', Filters=vpc_filter),
+            'security-group': lambda: paginate(
+                session, 'describe_security_groups', 'SecurityGroups',
+                Filters=vpc_filter),
+            'instance': lambda: paginate(session, 'describe_instances',
+                                         'Reservations', Filters=vpc_filter),
         }
-    )
 
-    write_output_json('ec2_instance.json', instance)
+    calls = {
+        'vpc': lambda: paginate(
+            session, 'describe_vpcs', 'Vpcs',
+            Filters=[{'Name': 'tag:Name', 'Values': [name]}]),
+        'internet-gateway': lambda: paginate(
+            session, 'describe_internet_gateways', 'InternetGateways',
+            Filters=[{'Name': 'tag:Name', 'Values': [name]}]),
+    }
+    if vpc_ids:
+        calls.update(vpc_calls(vpc_ids))
+
+    with ContextThreadPoolExecutor(max_workers=6) as executor:
+        def run(calls):
+            futures = {resource_type: executor.submit(lambda c: list(c()), c)
+                       for resource_type, c in calls.items()}
+            return {resource_type: future.result()
+                    for resource_type, future in futures.items()}
+
+        result = run(calls)
+        if not vpc_ids:
+            vpc_ids = [v['VpcId'] for v in result['vpc']]
+            if vpc_ids:
+                result.update(run(vpc_calls(vpc_ids)))
+            else:
+                result.update({resource_type: [] for resource_type
+                               in vpc_calls(vpc_ids)})
+
+    return result
+
+
+def inventory_graph(resources):
+    """Join describe results into VPC -> subnets -> route table, instances"""
+    vpcs = {v['VpcId']: dict(v, InternetGateways=[], SecurityGroups=[],
+                             RouteTables=[], Subnets=[])
+            for v in resources['vpc']}
+    detached_igws = []
+    for igw in resources['internet-gateway']:
+        vpc_ids = [a['VpcId'] for a in igw.get('Attachments', [])
+                   if a.get('VpcId') in vpcs]
+        for vpc_id in vpc_ids:
+            vpcs[vpc_id]['InternetGateways'].append(igw)
+        if not vpc_ids:
+            detached_igws.append(igw)
+    for group in resources['security-group']:
+        if group.get('VpcId') in vpcs:
+            vpcs[group['VpcId']]['SecurityGroups'].append(group)
+
+    subnet_rts = {}
+    main_rts = {}
+    for route_table in resources['route-table']:
+        if route_table.get('VpcId') in vpcs:
+            vpcs[route_table['VpcId']]['RouteTables'].append(route_table)
+        for association in route_table.get('Associations', []):
+            if association.get('Main'):
+                main_rts[route_table['VpcId']] = route_table
+            elif association.get('SubnetId'):
+                subnet_rts[association['SubnetId']] = route_table
+
+    subnets = {}
+    for subnet in resources['subnet']:
+        if subnet.get('VpcId') not in vpcs:
+            continue
+        route_table = subnet_rts.get(subnet['SubnetId'],
+                                     main_rts.get(subnet['VpcId']))
+        subnets[subnet['SubnetId']] = dict(
+            subnet, RouteTableId=(route_table or {}).get('RouteTableId'),
+            Instances=[])
+        vpcs[subnet['VpcId']]['Subnets'].append(subnets[subnet['SubnetId']])
+    for instance in resources['instance']:
+        if instance.get('SubnetId') in subnets:
+            subnets[instance['SubnetId']]['Instances'].append(instance)
+
+    return {
+        'Vpcs': list(vpcs.values()),
+        'DetachedInternetGateways': detached_igws,
+    }
+
+
+def inventory(args):
+    """Snapshot of every resource in a stack"""
+    if args.debug:
+        print('Inventory')
+        print(f'args: {args}')
 
+    session = get_session(args.profile, args.region)
+    resources = inventory_fetch(session, name=args.name)
+    print(json.dumps(inventory_graph(resources), indent=2, default=str))
+
+
+# Fields that change without anyone changing the resource
+_VOLATILE_FIELDS = {
+    'subnet': {'AvailableIpAddressCount'},
+    'instance': {'StateTransitionReason', 'StateReason',
+                 'UsageOperationUpdateTime'},
+}
+
+
+def fingerprint(resource_type, resource):
+    """Hash of the fields of a resource that aren't volatile"""
+    volatile = _VOLATILE_FIELDS.get(resource_type, ())
+    fields = {k: v for k, v in resource.items() if k not in volatile}
+    return hashlib.sha256(json.dumps(fields, sort_keys=True,
+                                     default=str).encode()).hexdigest()
+
+
+class StackWatcher:
+    """Last snapshot of a stack, turning each new one into change events
+
+    The snapshot keeps a fingerprint per resource, so only resources whose
+    fingerprint changed are compared field by field.
+    """
+
+    def __init__(self, session, name=DEFAULT_NAME):
+        self.session = session
+        self.name = name
+        self.snapshot = None
+        self.drift = {}
+
+    def event(self, event, resource_type, resource_id, resource=None,
+              **fields):
+        return dict({
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'region': self.session.region_name,
+            'stack': self.name,
+            'event': event,
+            'type': resource_type,
+            'id': resource_id,
+            'name': name_tag(resource) if resource else None,
+        }, **fields)
+
+    def poll(self):
+        """Describe the stack, return events for what changed since last"""
+        snapshot = {}
+        for resource_type, items in inventory_fetch(self.session,
+                                                    self.name).items():
+            id_field = _ID_FIELDS[resource_type]
+            for item in items:
+                snapshot[(resource_type, item[id_field])] = (
+                    fingerprint(resource_type, item), item)
+
+        events = []
+        if self.snapshot is not None:
+            before = self.snapshot
+            for key in sorted(snapshot.keys() - before.keys()):
+                events.append(self.event('created', *key, snapshot[key][1]))
+            for key in sorted(before.keys() - snapshot.keys()):
+                events.append(self.event('deleted', *key, before[key][1]))
+            for key in sorted(snapshot.keys() & before.keys()):
+                (new_hash, new), (old_hash, old) = snapshot[key], before[key]
+                if new_hash != old_hash:
+                    changed = sorted(k for k in new.keys() | old.keys()
+                                     if new.get(k) != old.get(k))
+                    events.append(self.event('modified', *key, new,
+                                             fields=changed))
+
+        drift = self.recorded_drift(snapshot)
+        for key in sorted(drift.keys() - self.drift.keys()):
+            resource_type, name = key
+            resource_id, reason = drift[key]
+            events.append(self.event('drifted', resource_type, resource_id,
+                                     name=name, reason=reason))
+        self.snapshot = snapshot
+        self.drift = drift
+        return events
+
+    def recorded_drift(self, snapshot):
+        """{(type, name): (id, reason)} where EC2 differs from state"""
+        state = get_state()
+        state.reload()
+        drift = {}
+        for resource_type in _INDEXED_TYPES:
+            for name, resource_id in state.named_ids(
+                    resource_type, prefix=self.name).items():
+                # Not demo2-* when watching demo
+                if name != self.name and not name.startswith(
+                        f'{self.name}-'):
+                    continue
+                current = snapshot.get((resource_type, resource_id))
+                if current is None:
+                    drift[(resource_type, name)] = (resource_id, 'missing')
+                elif name_tag(current[1]) != name:
+                    drift[(resource_type, name)] = (resource_id, 'renamed')
+        return drift
+
+
+def watch(args):
+    """Poll stacks and print what changed as NDJSON"""
+    if args.debug:
+        print('Watch')
+        print(f'args: {args}')
 
-if __name__ == '__main__':
-    Path('outputs').mkdir(exist_ok=True)
+    session = get_session(args.profile, args.region)
+    watchers = [StackWatcher(session, name.strip())
+                for name in args.name.split(',') if name.strip()]
+    interval = args.interval
+    polls = 0
+    with ContextThreadPoolExecutor(
+            max_workers=min(len(watchers), DEFAULT_WORKERS)) as executor:
+        while True:
+            changed = False
+            for events in executor.map(StackWatcher.poll, watchers):
+                for event in events:
+                    print(json.dumps(event, default=str), flush=True)
+                    changed = True
+            polls += 1
+            if args.count and polls >= args.count:
+                return
+            # Poll less often while nothing changes
+            interval = (args.interval if changed
+                        else min(interval * 2, args.max_interval))
+            time.sleep(interval)
+            # Stops the command once a serve client went away
+            sys.stdout.flush()
+
+
+def retry_dependency(func, *args, attempts=8, delay=1.0, **kwargs):
+    """Call func, retrying while EC2 reports a DependencyViolation
+
+    Deleting right after the resources that used something went away often
+    fails until EC2 catches up, e.g. a security group still in use by the
+    network interface of a terminated instance.
+    """
+    from botocore.exceptions import ClientError
+    for attempt in range(attempts):
+        try:
+            return func(*args, **kwargs)
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code != 'DependencyViolation' or attempt == attempts - 1:
+                raise
+            time.sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, WAIT_MAX_DELAY)
+
+
+def deletable(resource_type, resource):
+    """Whether destroy deletes a resource itself
+
+    Main route tables and default security groups go with their VPC, and
+    terminated instances are already gone.
+    """
+    if resource_type == 'route-table':
+        return not any(a.get('Main') for a in resource.get('Associations', []))
+    if resource_type == 'security-group':
+        return resource.get('GroupName') != 'default'
+    if resource_type == 'instance':
+        return _resource_state(resource) != 'terminated'
+    return True
+
+
+def destroy_steps(session, resources, max_workers=DEFAULT_WORKERS):
+    """Teardown steps as {step: (callable, dependencies)}
+
+    Dependencies run in reverse provisioning order: instances, then routes
+    and route table associations, then the internet gateway, subnets and
+    security groups, and the VPC last. Each step deletes its resources
+    concurrently.
+    """
+    client = get_client(session)
+    deleted = []
+
+    def each(func, items):
+        with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(func, items))
+
+    igw_ids = [igw['InternetGatewayId']
+               for igw in resources['internet-gateway']]
+    instance_ids = [i['InstanceId'] for i in resources['instance']
+                    if deletable('instance', i)]
+
+    def instances_step(session):
+        if instance_ids:
+            client.terminate_instances(InstanceIds=instance_ids)
+            wait_for(session, {'instance': instance_ids},
+                     states={'instance': 'terminated'})
+            print(f'Instances terminated: {instance_ids}')
+            deleted.extend(instance_ids)
+
+    def route_tables_step(session):
+        def routes(route_table):
+            for route in route_table.get('Routes', []):
+                if route.get('GatewayId') in igw_ids:
+                    key = ('DestinationIpv6CidrBlock'
+                           if 'DestinationIpv6CidrBlock' in route
+                           else 'DestinationCidrBlock')
+                    client.delete_route(
+                        RouteTableId=route_table['RouteTableId'],
+                        **{key: route[key]})
+            for association in route_table.get('Associations', []):
+                if not association.get('Main'):
+                    client.disassociate_route_table(
+                        AssociationId=association['RouteTableAssociationId'])
+
+        def delete(route_table):
+            route_table_id = route_table['RouteTableId']
+            retry_dependency(client.delete_route_table,
+                             RouteTableId=route_table_id)
+            print(f'Route table deleted: {route_table_id}')
+            deleted.append(route_table_id)
+
+        each(routes, resources['route-table'])
+        each(delete, [r for r in resources['route-table']
+                      if deletable('route-table', r)])
+
+    def igw_step(session):
+        def delete(igw):
+            igw_id = igw['InternetGatewayId']
+            for attachment in igw.get('Attachments', []):
+                retry_dependency(client.detach_internet_gateway,
+                                 InternetGatewayId=igw_id,
+                                 VpcId=attachment['VpcId'])
+            client.delete_internet_gateway(InternetGatewayId=igw_id)
+            print(f'Internet Gateway deleted: {igw_id}')
+            deleted.append(igw_id)
+
+        each(delete, resources['internet-gateway'])
+
+    def subnets_step(session):
+        def delete(subnet):
+            retry_dependency(client.delete_subnet,
+                             SubnetId=subnet['SubnetId'])
+            print(f'Subnet deleted: {subnet["SubnetId"]}')
+            deleted.append(subnet['SubnetId'])
+
+        each(delete, resources['subnet'])
+
+    def security_groups_step(session):
+        def delete(group):
+            retry_dependency(client.delete_security_group,
+                             GroupId=group['GroupId'])
+            print(f'Security group deleted: {group["GroupId"]}')
+            deleted.append(group['GroupId'])
+
+        each(delete, [g for g in resources['security-group']
+                      if deletable('security-group', g)])
+
+    def vpc_step(session):
+        for vpc in resources['vpc']:
+            retry_dependency(client.delete_vpc, VpcId=vpc['VpcId'])
+            print(f'VPC deleted: {vpc["VpcId"]}')
+            deleted.append(vpc['VpcId'])
+
+    steps = {
+        'instances': (instances_step, []),
+        'route_tables': (route_tables_step, ['instances']),
+        'igw': (igw_step, ['instances', 'route_tables']),
+        'subnets': (subnets_step, ['instances', 'route_tables']),
+        'security_groups': (security_groups_step, ['instances']),
+        'vpc': (vpc_step, ['igw', 'subnets', 'security_groups']),
+    }
+    return steps, deleted
+
+
+def destroy(args):
+    """Delete every resource of a stack"""
+    if args.debug:
+        print('Destroy')
+        print(f'args: {args}')
 
+    session = get_session(args.profile, args.region)
+    resources = inventory_fetch(session, name=args.name)
+    if not any(resources.values()):
+        print(f'Nothing to destroy for stack {args.name}')
+        return
+    if not args.yes:
+        for resource_type, items in resources.items():
+            id_field = _ID_FIELDS[resource_type]
+            for item in items:
+                if deletable(resource_type, item):
+                    print(f'Would delete {resource_type}: {item[id_field]}')
+        print('Run again with --yes to delete.')
+        return
+
+    start = time.perf_counter()
+    steps, deleted = destroy_steps(session, resources,
+                                   max_workers=args.workers)
+    try:
+        run_dag(steps, lambda step, func: func(session),
+                max_workers=args.workers)
+    finally:
+        get_state().remove_ids(deleted)
+    print(f'Stack {args.name} destroyed in {time.perf_counter() - start:.1f}s')
+
+
+if __name__ == '__main__':
     main()
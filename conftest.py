@@ -0,0 +1 @@
+"""Lets the tests under tests/ import cli.py from the repository root"""
@@ -0,0 +1,98 @@
+import ipaddress
+import itertools
+
+import pytest
+
+import cli
+
+
+def assert_disjoint(networks):
+    for a, b in itertools.combinations(networks, 2):
+        assert not a.overlaps(b), f'{a} overlaps {b}'
+
+
+def test_allocates_lowest_blocks_in_order():
+    allocator = cli.CidrAllocator('10.0.0.0/24')
+
+    cidrs = [str(allocator.allocate(28)) for _ in range(3)]
+
+    assert cidrs == ['10.0.0.0/28', '10.0.0.16/28', '10.0.0.32/28']
+
+
+def test_blocks_are_aligned_and_inside_the_vpc():
+    network = ipaddress.ip_network('10.0.0.0/16')
+    allocator = cli.CidrAllocator(network, ['10.0.0.16/28'])
+
+    blocks = [allocator.allocate(prefixlen)
+              for prefixlen in (28, 24, 26, 28, 20, 27)]
+
+    for block in blocks:
+        assert block.subnet_of(network)
+        # ip_network() raises for host bits set, i.e. a misaligned block
+        assert ipaddress.ip_network(str(block)) == block
+
+
+def test_blocks_never_overlap_used_or_each_other():
+    used = ['10.0.0.0/28', '10.0.0.64/26', '10.0.1.0/24', '10.0.8.0/21']
+    allocator = cli.CidrAllocator('10.0.0.0/16', used)
+
+    blocks = [allocator.allocate(prefixlen)
+              for prefixlen in [28] * 20 + [24] * 10 + [22] * 5]
+
+    assert_disjoint(blocks + [ipaddress.ip_network(c) for c in used])
+
+
+def test_used_blocks_outside_the_vpc_are_ignored():
+    allocator = cli.CidrAllocator('10.0.0.0/24', ['192.168.0.0/24'])
+
+    assert str(allocator.allocate(24)) == '10.0.0.0/24'
+
+
+def test_exhaustion_raises():
+    allocator = cli.CidrAllocator('10.0.0.0/26', ['10.0.0.0/27'])
+
+    assert [str(allocator.allocate(28)) for _ in range(2)] == [
+        '10.0.0.32/28', '10.0.0.48/28']
+    with pytest.raises(ValueError, match='No free /28'):
+        allocator.allocate(28)
+
+
+def test_larger_than_the_vpc_raises():
+    allocator = cli.CidrAllocator('10.0.0.0/24')
+
+    with pytest.raises(ValueError):
+        allocator.allocate(16)
+
+
+def test_no_block_large_enough_raises():
+    # Half the VPC is free, but not as one aligned /24
+    allocator = cli.CidrAllocator('10.0.0.0/23', ['10.0.0.64/26',
+                                                  '10.0.1.64/26'])
+
+    with pytest.raises(ValueError):
+        allocator.allocate(24)
+    assert str(allocator.allocate(25)) == '10.0.0.128/25'
+
+
+def test_release_merges_blocks_back():
+    allocator = cli.CidrAllocator('10.0.0.0/24')
+    blocks = [allocator.allocate(26) for _ in range(4)]
+    with pytest.raises(ValueError):
+        allocator.allocate(26)
+
+    for block in reversed(blocks):
+        allocator.release(block)
+
+    assert str(allocator.allocate(24)) == '10.0.0.0/24'
+
+
+def test_subnet_specs_keep_existing_cidrs_and_fill_gaps():
+    existing = [{'CidrBlock': '10.0.0.16/28',
+                 'Tags': [{'Key': 'Name', 'Value': 'demo-az-b'}]}]
+
+    specs = cli.subnet_specs(['az-a', 'az-b', 'az-c'], 'demo',
+                             existing=existing)
+
+    assert specs == [('demo-az-a', 'az-a', '10.0.0.0/28'),
+                     ('demo-az-b', 'az-b', '10.0.0.16/28'),
+                     ('demo-az-c', 'az-c', '10.0.0.32/28')]
@@ -0,0 +1,104 @@
+import pytest
+
+import cli
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cli.time, 'time', clock)
+    return clock
+
+
+def test_entries_expire_after_their_types_ttl(clock):
+    cache = cli.DescribeCache(ttl=60, ttls={'instance': 5})
+    cache.put('vpcs', 'vpc', {'Vpcs': []})
+    cache.put('instances', 'instance', {'Reservations': []})
+
+    clock.now += 10
+
+    assert cache.get('vpcs') == {'Vpcs': []}
+    assert cache.get('instances') is None
+
+    clock.now += 60
+
+    assert cache.get('vpcs') is None
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = cli.DescribeCache(max_entries=2)
+    cache.put('a', 'vpc', 'A')
+    cache.put('b', 'vpc', 'B')
+    assert cache.get('a') == 'A'
+
+    cache.put('c', 'vpc', 'C')
+
+    assert cache.get('a') == 'A'
+    assert cache.get('b') is None
+    assert cache.get('c') == 'C'
+
+
+def test_invalidate_drops_only_that_type(clock):
+    cache = cli.DescribeCache()
+    cache.put('vpcs', 'vpc', 'V')
+    cache.put('subnets', 'subnet', 'S')
+
+    clock.now += 1
+    cache.invalidate('subnet')
+
+    assert cache.get('vpcs') == 'V'
+    assert cache.get('subnets') is None
+
+
+def test_entries_stored_after_invalidating_are_served(clock):
+    cache = cli.DescribeCache()
+    cache.invalidate('subnet')
+
+    clock.now += 1
+    cache.put('subnets', 'subnet', 'S')
+
+    assert cache.get('subnets') == 'S'
+
+
+def test_entries_are_shared_through_the_file(clock, tmp_path):
+    path = tmp_path / 'describe_cache.json'
+    first = cli.DescribeCache(path)
+    second = cli.DescribeCache(path)
+
+    first.put('vpcs', 'vpc', 'V')
+
+    assert second.get('vpcs') == 'V'
+
+
+def test_invalidating_in_one_process_reaches_the_other(clock, tmp_path):
+    path = tmp_path / 'describe_cache.json'
+    first = cli.DescribeCache(path)
+    second = cli.DescribeCache(path)
+    first.put('subnets', 'subnet', 'S')
+    assert second.get('subnets') == 'S'
+
+    clock.now += 1
+    second.invalidate('subnet')
+
+    assert first.get('subnets') is None
+    assert cli.DescribeCache(path).get('subnets') is None
+
+
+def test_an_older_invalidation_does_not_win(clock, tmp_path):
+    path = tmp_path / 'describe_cache.json'
+    first = cli.DescribeCache(path)
+    second = cli.DescribeCache(path)
+    first.invalidate('subnet')
+
+    clock.now += 1
+    second.put('subnets', 'subnet', 'S')
+
+    assert first.get('subnets') == 'S'
@@ -0,0 +1,46 @@
+import pytest
+
+import cli
+
+
+def test_fleet_chunks_spreads_evenly():
+    chunks = cli.fleet_chunks(['subnet-a', 'subnet-b', 'subnet-c'], 10)
+
+    assert chunks == [('subnet-a', 4), ('subnet-b', 3), ('subnet-c', 3)]
+
+
+def test_fleet_chunks_splits_by_chunk_size():
+    chunks = cli.fleet_chunks(['subnet-a', 'subnet-b'], 7, chunk_size=2)
+
+    assert chunks == [('subnet-a', 2), ('subnet-a', 2),
+                      ('subnet-b', 2), ('subnet-b', 1)]
+    assert all(size <= 2 for _, size in chunks)
+
+
+def test_fleet_chunks_skips_subnets_without_instances():
+    chunks = cli.fleet_chunks(['subnet-a', 'subnet-b', 'subnet-c'], 2)
+
+    assert chunks == [('subnet-a', 1), ('subnet-b', 1)]
+
+
+def test_fleet_chunks_launches_count():
+    chunks = cli.fleet_chunks([f'subnet-{i}' for i in range(7)], 503,
+                              chunk_size=50)
+
+    assert sum(size for _, size in chunks) == 503
+
+
+@pytest.mark.parametrize('chunk_size', [0, -1])
+def test_fleet_chunks_rejects_chunk_size_below_one(chunk_size):
+    with pytest.raises(ValueError):
+        cli.fleet_chunks(['subnet-a'], 3, chunk_size=chunk_size)
+
+
+@pytest.mark.parametrize('option', ['--count', '--workers', '--chunk_size'])
+def test_ec2_options_below_one_are_usage_errors(option, capsys):
+    with pytest.raises(SystemExit) as e:
+        cli.main(['ec2', '--action', 'create', option, '0'])
+
+    assert e.value.code == 2
+    assert f'argument {option}: expected a whole number of at least 1' in (
+        capsys.readouterr().err)
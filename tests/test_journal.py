@@ -0,0 +1,113 @@
+from urllib.parse import parse_qs
+
+import botocore.session
+import pytest
+from botocore.awsrequest import AWSResponse
+
+import cli
+
+RESPONSE = b'''<CreateRouteTableResponse>
+  <requestId>1</requestId>
+  <routeTable>
+    <routeTableId>rtb-1</routeTableId>
+    <vpcId>vpc-1</vpcId>
+  </routeTable>
+</CreateRouteTableResponse>'''
+
+
+class Body:
+    def stream(self):
+        yield RESPONSE
+
+
+class Lost(Exception):
+    """A call that never got a response"""
+
+
+@pytest.fixture
+def sent():
+    return []
+
+
+@pytest.fixture
+def client(sent):
+    session = botocore.session.Session()
+    client = session.create_client(
+        'ec2', region_name='ap-southeast-2', aws_access_key_id='testing',
+        aws_secret_access_key='testing')
+    cli._register_hooks(client.meta.events)
+
+    def send(request, **kwargs):
+        sent.append({k: v[0] for k, v in parse_qs(request.body).items()})
+        if sent[-1].get('VpcId') == 'vpc-lost':
+            raise Lost()
+        return AWSResponse(request.url, 200, {}, Body())
+
+    client.meta.events.register('before-send', send)
+    return client
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return cli.Journal(tmp_path / 'journal.jsonl')
+
+
+def in_run(run, func, *args, **kwargs):
+    token = cli._journal_run.set(run)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        cli._journal_run.reset(token)
+
+
+def test_calls_done_before_are_replayed_not_sent(client, journal, sent):
+    run = journal.start('demo', ['rt_create'])
+    in_run(run, client.create_route_table, VpcId='vpc-1')
+    assert len(sent) == 1
+
+    response = in_run(journal.last_run('demo'), client.create_route_table,
+                      VpcId='vpc-1')
+
+    assert len(sent) == 1
+    assert response['RouteTable']['RouteTableId'] == 'rtb-1'
+
+
+def test_calls_not_done_are_sent_again(client, journal, sent):
+    run = journal.start('demo', ['rt_create'])
+    in_run(run, client.create_route_table, VpcId='vpc-1')
+
+    in_run(journal.last_run('demo'), client.create_route_table,
+           VpcId='vpc-2')
+
+    assert len(sent) == 2
+
+
+def test_resume_reuses_the_client_token(client, journal, sent):
+    run = journal.start('demo', ['rt_create'])
+    with pytest.raises(Lost):
+        in_run(run, client.create_route_table, VpcId='vpc-lost')
+
+    with pytest.raises(Lost):
+        in_run(journal.last_run('demo'), client.create_route_table,
+               VpcId='vpc-lost')
+
+    assert len(sent) == 2
+    assert sent[0]['ClientToken'] == sent[1]['ClientToken']
+    assert [e['key'] for e in journal.events() if e['event'] == 'call'] == [
+        sent[0]['ClientToken']] * 2
+
+
+def test_identical_calls_get_their_own_tokens(client, journal, sent):
+    run = journal.start('demo', ['rt_create'])
+
+    in_run(run, client.create_route_table, VpcId='vpc-1')
+    in_run(run, client.create_route_table, VpcId='vpc-1')
+
+    assert sent[0]['ClientToken'] != sent[1]['ClientToken']
+
+
+def test_calls_outside_a_run_are_not_journaled(client, journal, sent):
+    client.create_route_table(VpcId='vpc-1')
+
+    assert len(sent[0]['ClientToken']) != 64
+    assert journal.events() == []
@@ -0,0 +1,67 @@
+import pytest
+
+import cli
+
+
+@pytest.mark.parametrize('option, value', [
+    ('--cache_ttl', 'bogus=30'),
+    ('--cache_ttl', 'subnet=soon'),
+    ('--cache_ttl', '-5'),
+    ('--api_rate', 'mutate'),
+    ('--api_rate', 'bogus=5'),
+    ('--api_rate', 'mutate=fast'),
+    ('--api_rate', 'mutate=5/x'),
+    ('--api_rate', 'describe=0'),
+    ('--metadata_ttl', 'az'),
+    ('--metadata_ttl', 'region=60'),
+    ('--metadata_ttl', 'ami=x'),
+])
+def test_malformed_values_are_usage_errors(option, value, capsys):
+    with pytest.raises(SystemExit) as e:
+        cli.main([f'{option}={value}', 'vpc', '--action', 'info'])
+
+    assert e.value.code == 2
+    assert f'argument {option}:' in capsys.readouterr().err
+
+
+def test_parse_cache_ttl():
+    assert cli.parse_cache_ttl('30') == (None, 30.0)
+    assert cli.parse_cache_ttl('subnet=300') == ('subnet', 300.0)
+
+
+def test_parse_api_rate():
+    assert cli.parse_api_rate('mutate=5') == ('mutate', 5.0, None)
+    assert cli.parse_api_rate('describe=2.5/50') == ('describe', 2.5, 50)
+
+
+def test_parse_metadata_ttl():
+    assert cli.parse_metadata_ttl('ami=3600') == ('ami', 3600.0)
+
+
+@pytest.mark.parametrize('argv', [
+    ['--region_workers', '0', 'vpc', '--action', 'info'],
+    ['--max_attempts', '0', 'vpc', '--action', 'info'],
+    ['--max_pool_connections', '0', 'vpc', '--action', 'info'],
+    ['subnet', '--action', 'create', '--workers', '0'],
+    ['subnet', '--action', 'create', '--per_az', '-1'],
+    ['route_table', '--action', 'sync_routes', '--workers', '0'],
+    ['security_group', '--action', 'apply_rules', '--batch_size', '0'],
+    ['apply', '--workers', '0'],
+    ['resume', '--workers', 'x'],
+    ['destroy', '--workers', '-2'],
+])
+def test_counts_below_one_are_usage_errors(argv, capsys):
+    with pytest.raises(SystemExit) as e:
+        cli.main(argv)
+
+    assert e.value.code == 2
+    assert 'expected a whole number of at least 1' in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('value', ['15', '29', '0', 'x'])
+def test_prefix_length_outside_ec2_range_is_a_usage_error(value, capsys):
+    with pytest.raises(SystemExit) as e:
+        cli.main(['subnet', '--action', 'create', '--prefix_length', value])
+
+    assert e.value.code == 2
+    assert 'expected a prefix length from 16 to 28' in capsys.readouterr().err
@@ -0,0 +1,53 @@
+import cli
+
+
+class FakeClient:
+    """EC2 client answering each operation with one canned page"""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def can_paginate(self, operation):
+        return False
+
+    def __getattr__(self, operation):
+        def call(**params):
+            self.calls.append((operation, params))
+            return self.pages.get(operation, {})
+        return call
+
+
+def reservations(*instance_ids):
+    return {'Reservations': [
+        {'ReservationId': 'r-1',
+         'Instances': [{'InstanceId': i, 'SubnetId': 'subnet-1'}
+                       for i in instance_ids]},
+    ]}
+
+
+def test_paginate_yields_instances_not_reservations(monkeypatch):
+    client = FakeClient({'describe_instances': reservations('i-1', 'i-2')})
+    monkeypatch.setattr(cli, 'get_client', lambda session: client)
+
+    instances = list(cli.paginate(None, 'describe_instances',
+                                  'Reservations'))
+
+    assert [i['InstanceId'] for i in instances] == ['i-1', 'i-2']
+
+
+def test_inventory_fetch_reports_instances(monkeypatch):
+    client = FakeClient({
+        'describe_vpcs': {'Vpcs': [{'VpcId': 'vpc-1'}]},
+        'describe_subnets': {'Subnets': [{'SubnetId': 'subnet-1',
+                                          'VpcId': 'vpc-1'}]},
+        'describe_instances': reservations('i-1'),
+    })
+    monkeypatch.setattr(cli, 'get_client', lambda session: client)
+
+    resources = cli.inventory_fetch(None, vpc_ids=['vpc-1'])
+    graph = cli.inventory_graph(resources)
+
+    assert [i['InstanceId'] for i in resources['instance']] == ['i-1']
+    subnet, = graph['Vpcs'][0]['Subnets']
+    assert [i['InstanceId'] for i in subnet['Instances']] == ['i-1']
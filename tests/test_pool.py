@@ -0,0 +1,76 @@
+from types import SimpleNamespace
+
+import pytest
+
+import cli
+
+
+class FakeClient:
+    def __init__(self, fail_start=False):
+        self.fail_start = fail_start
+        self.tags = {}
+        self.started = []
+
+    def create_tags(self, Resources, Tags):
+        for resource in Resources:
+            self.tags.setdefault(resource, {}).update(
+                {t['Key']: t['Value'] for t in Tags})
+
+    def start_instances(self, InstanceIds):
+        if self.fail_start:
+            raise RuntimeError('InsufficientInstanceCapacity')
+        self.started.extend(InstanceIds)
+
+
+@pytest.fixture
+def pool(monkeypatch, tmp_path):
+    pool = SimpleNamespace(client=FakeClient(), stopped=['i-1', 'i-2'],
+                           claimed_elsewhere=set(), launched=[])
+
+    def paginate(session, operation, result_key, InstanceIds):
+        for instance_id in InstanceIds:
+            tags = dict(pool.client.tags.get(instance_id, {}))
+            if instance_id in pool.claimed_elsewhere:
+                tags[cli.POOL_CLAIM_TAG] = 'other'
+            yield {'InstanceId': instance_id,
+                   'Tags': [{'Key': k, 'Value': v} for k, v in tags.items()]}
+
+    def launch_instances(session, name, count, tags, **kwargs):
+        pool.launched = [f'i-new{n}' for n in range(count)]
+        return pool.launched
+
+    monkeypatch.setattr(cli, 'get_client', lambda session: pool.client)
+    monkeypatch.setattr(cli, 'pool_instances',
+                        lambda *args, **kwargs: list(pool.stopped))
+    monkeypatch.setattr(cli, 'paginate', paginate)
+    monkeypatch.setattr(cli, 'launch_instances', launch_instances)
+    monkeypatch.setattr(cli, 'wait_for', lambda *args, **kwargs: None)
+    monkeypatch.setattr(cli, 'output_dir', lambda: tmp_path)
+    return pool
+
+
+def test_acquire_starts_pooled_instances(pool):
+    assert cli.pool_acquire(None, count=2) == (['i-1', 'i-2'], 2)
+
+    assert pool.client.started == ['i-1', 'i-2']
+    assert pool.client.tags['i-1'][cli.POOL_TAG] == 'acquired'
+    assert pool.launched == []
+
+
+def test_acquire_leaves_instances_another_acquire_claimed(pool):
+    pool.claimed_elsewhere = {'i-1'}
+
+    instance_ids, available = cli.pool_acquire(None, count=2)
+
+    assert instance_ids == ['i-2', 'i-new0']
+    assert pool.client.started == ['i-2']
+
+
+def test_instances_that_fail_to_start_go_back_to_the_pool(pool):
+    pool.client.fail_start = True
+
+    with pytest.raises(RuntimeError):
+        cli.pool_acquire(None, count=2)
+
+    assert pool.client.tags['i-1'][cli.POOL_TAG] == 'available'
+    assert pool.client.tags['i-2'][cli.POOL_TAG] == 'available'
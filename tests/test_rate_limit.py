@@ -0,0 +1,129 @@
+import threading
+
+import pytest
+
+import cli
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cli.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(cli.time, 'sleep', clock.sleep)
+    return clock
+
+
+def test_bucket_allows_a_burst_of_its_capacity(clock):
+    bucket = cli.TokenBucket(rate=2, capacity=3)
+
+    for _ in range(3):
+        bucket.acquire()
+
+    assert clock.slept == []
+
+
+def test_bucket_sleeps_until_the_next_token(clock):
+    bucket = cli.TokenBucket(rate=2, capacity=1)
+    bucket.acquire()
+
+    bucket.acquire()
+
+    assert clock.slept == [pytest.approx(0.5)]
+
+
+def test_bucket_refills_up_to_its_capacity(clock):
+    bucket = cli.TokenBucket(rate=4, capacity=2)
+    bucket.acquire()
+    bucket.acquire()
+
+    clock.now += 60
+    for _ in range(2):
+        bucket.acquire()
+    assert clock.slept == []
+
+    bucket.acquire()
+    assert clock.slept == [pytest.approx(0.25)]
+
+
+def test_window_halves_once_per_burst_of_throttling(clock):
+    window = cli.ConcurrencyWindow(8)
+
+    window.throttled()
+    window.throttled()
+    assert window.limit == 4
+
+    clock.now += 1
+    window.throttled()
+    assert window.limit == 2
+
+
+def test_window_does_not_go_below_its_minimum(clock):
+    window = cli.ConcurrencyWindow(4, minimum=2)
+
+    for _ in range(3):
+        window.throttled()
+        clock.now += 1
+
+    assert window.limit == 2
+
+
+def test_window_grows_back_by_one_per_window_of_successes(clock):
+    window = cli.ConcurrencyWindow(8)
+    window.throttled()
+
+    for _ in range(4):
+        window.acquire()
+        window.release()
+
+    assert window.limit == pytest.approx(5, abs=0.1)
+
+
+def test_window_grows_no_further_than_its_maximum():
+    window = cli.ConcurrencyWindow(2)
+
+    for _ in range(10):
+        window.acquire()
+        window.release()
+
+    assert window.limit == 2
+
+
+@pytest.mark.parametrize('limit', [0, -3])
+def test_window_limit_is_at_least_its_minimum(limit):
+    window = cli.ConcurrencyWindow(limit)
+
+    assert window.limit == 1
+    window.acquire()
+    window.release()
+
+
+def test_window_blocks_calls_over_its_limit():
+    window = cli.ConcurrencyWindow(1)
+    window.acquire()
+    entered = threading.Event()
+
+    def call():
+        window.acquire()
+        entered.set()
+        window.release()
+
+    thread = threading.Thread(target=call)
+    thread.start()
+    assert not entered.wait(0.1)
+
+    window.release()
+    assert entered.wait(5)
+    thread.join()
@@ -0,0 +1,150 @@
+import pytest
+
+import cli
+
+
+def route_table(rt_id, routes=(), associations=()):
+    return {'RouteTableId': rt_id, 'Routes': list(routes),
+            'Associations': list(associations)}
+
+
+def test_route_changes_creates_replaces_and_deletes():
+    current = {'0.0.0.0/0': 'igw-old', '10.1.0.0/16': 'pcx-1',
+               '10.2.0.0/16': 'tgw-1'}
+    routes = {'0.0.0.0/0': 'igw-new', '10.1.0.0/16': 'pcx-1',
+              '10.3.0.0/16': 'nat-1', '2001:db8::/32': 'eni-1'}
+
+    assert cli.route_changes(current, routes) == [
+        ('replace', '0.0.0.0/0', {'DestinationCidrBlock': '0.0.0.0/0',
+                                  'GatewayId': 'igw-new'}),
+        ('create', '10.3.0.0/16', {'DestinationCidrBlock': '10.3.0.0/16',
+                                   'NatGatewayId': 'nat-1'}),
+        ('create', '2001:db8::/32', {
+            'DestinationIpv6CidrBlock': '2001:db8::/32',
+            'NetworkInterfaceId': 'eni-1'}),
+        ('delete', '10.2.0.0/16', {'DestinationCidrBlock': '10.2.0.0/16'}),
+    ]
+
+
+def test_route_changes_up_to_date():
+    routes = {'0.0.0.0/0': 'igw-1', '::/0': 'igw-1'}
+
+    assert cli.route_changes(dict(routes), routes) == []
+
+
+def test_route_changes_deletes_ipv6_by_ipv6_destination():
+    assert cli.route_changes({'::/0': 'igw-1'}, {}) == [
+        ('delete', '::/0', {'DestinationIpv6CidrBlock': '::/0'})]
+
+
+def test_table_routes_leaves_out_local_and_propagated_routes():
+    table = route_table('rtb-1', routes=[
+        {'DestinationCidrBlock': '10.0.0.0/16', 'GatewayId': 'local',
+         'Origin': 'CreateRouteTable'},
+        {'DestinationCidrBlock': '10.9.0.0/16', 'GatewayId': 'vgw-1',
+         'Origin': 'EnableVgwRoutePropagation'},
+        {'DestinationCidrBlock': '0.0.0.0/0', 'GatewayId': 'igw-1',
+         'Origin': 'CreateRoute'},
+        {'DestinationIpv6CidrBlock': '::/0', 'GatewayId': 'igw-1',
+         'Origin': 'CreateRoute'},
+    ])
+
+    assert cli.table_routes(table) == {'0.0.0.0/0': 'igw-1',
+                                       '::/0': 'igw-1'}
+
+
+def test_synced_table_has_no_route_changes():
+    routes = {'0.0.0.0/0': 'igw-1', '10.1.0.0/16': 'pcx-1'}
+    table = route_table('rtb-1', routes=[
+        dict(cli.route_params(d, t), Origin='CreateRoute')
+        for d, t in routes.items()])
+
+    assert cli.route_changes(cli.table_routes(table), routes) == []
+
+
+def test_association_changes():
+    table = route_table('rtb-1', associations=[
+        {'SubnetId': 'subnet-1', 'RouteTableAssociationId': 'a-1'},
+        {'Main': True, 'RouteTableAssociationId': 'a-main'}])
+    other = route_table('rtb-2', associations=[
+        {'SubnetId': 'subnet-2', 'RouteTableAssociationId': 'a-2'}])
+
+    changes = cli.association_changes(
+        table, [table, other], ['subnet-1', 'subnet-2', 'subnet-3'])
+
+    assert changes == [
+        ('reassociate', 'subnet-2', {'AssociationId': 'a-2'}),
+        ('associate', 'subnet-3', {'SubnetId': 'subnet-3'}),
+    ]
+
+
+def test_read_routes(tmp_path):
+    path = tmp_path / 'routes.txt'
+    path.write_text('# peering\n'
+                    '10.1.0.0/16 pcx-1\n'
+                    '\n'
+                    '0.0.0.0/0 igw   # stack gateway\n'
+                    '2001:db8::/32 eni-1\n')
+
+    assert cli.read_routes(path, igw_id='igw-1') == {
+        '10.1.0.0/16': 'pcx-1', '0.0.0.0/0': 'igw-1',
+        '2001:db8::/32': 'eni-1'}
+
+
+@pytest.mark.parametrize('line', ['10.1.0.0/16', '10.1.0.0/16 vpc-1',
+                                  '10.1.0.1/16 pcx-1', '0.0.0.0/0 igw'])
+def test_read_routes_rejects_malformed_lines(tmp_path, line):
+    path = tmp_path / 'routes.txt'
+    path.write_text(f'10.1.0.0/16 pcx-1\n{line}\n')
+
+    with pytest.raises(ValueError, match=r'routes.txt:2:'):
+        cli.read_routes(path)
+
+
+def test_sync_routes_needs_a_routes_file(capsys):
+    with pytest.raises(SystemExit) as e:
+        cli.main(['route_table', '--action', 'sync_routes'])
+
+    assert e.value.code == 2
+    assert 'needs --routes_file' in capsys.readouterr().err
+
+
+@pytest.fixture
+def sync(monkeypatch, tmp_path):
+    routes_file = tmp_path / 'routes.txt'
+    routes_file.write_text('0.0.0.0/0 igw\n')
+    written = {}
+    monkeypatch.setattr(cli, 'configure', lambda args: None)
+    monkeypatch.setattr(cli, 'get_session', lambda *args: None)
+    monkeypatch.setattr(cli, 'resource_id', lambda *args: 'igw-1')
+    monkeypatch.setattr(cli, 'write_output_json', written.__setitem__)
+
+    def run(result):
+        monkeypatch.setattr(cli, 'rt_sync_routes',
+                            lambda *args, **kwargs: result)
+        cli.main(['route_table', '--action', 'sync_routes',
+                  '--routes_file', str(routes_file)])
+        return written
+    return run
+
+
+def test_sync_routes_succeeds_when_every_call_did(sync):
+    result = {'RouteTableId': 'rtb-1', 'create': ['0.0.0.0/0']}
+
+    assert sync(result) == {'route_sync.json': result}
+
+
+def test_failed_route_calls_fail_the_command(sync):
+    result = {'RouteTableId': 'rtb-1', 'create failed': ['0.0.0.0/0']}
+
+    with pytest.raises(SystemExit) as e:
+        sync(result)
+
+    assert e.value.code == 1
+
+
+def test_missing_route_table_fails_the_command(sync):
+    with pytest.raises(SystemExit) as e:
+        sync(None)
+
+    assert e.value.code == 1
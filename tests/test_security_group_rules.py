@@ -0,0 +1,104 @@
+import pytest
+
+import cli
+
+
+def write_rules(tmp_path, text):
+    path = tmp_path / 'rules.txt'
+    path.write_text(text)
+    return path
+
+
+def permission(protocol, from_port=None, to_port=None, *cidrs):
+    permission = {'IpProtocol': protocol,
+                  'IpRanges': [{'CidrIp': c} for c in cidrs if ':' not in c],
+                  'Ipv6Ranges': [{'CidrIpv6': c} for c in cidrs if ':' in c]}
+    if from_port is not None:
+        permission.update(FromPort=from_port, ToPort=to_port)
+    return permission
+
+
+@pytest.mark.parametrize('args, key', [
+    (('tcp', '22', '22', '10.0.0.1/32'), ('tcp', 22, 22, '10.0.0.1/32')),
+    (('6', 80, 443, '10.0.0.0/8'), ('tcp', 80, 443, '10.0.0.0/8')),
+    (('all', '', '', '0.0.0.0/0'), ('-1', None, None, '0.0.0.0/0')),
+    (('-1', -1, -1, '0.0.0.0/0'), ('-1', None, None, '0.0.0.0/0')),
+    (('icmp', '', '', '10.0.0.0/8'), ('icmp', -1, -1, '10.0.0.0/8')),
+    (('1', None, None, '10.0.0.0/8'), ('icmp', -1, -1, '10.0.0.0/8')),
+    (('icmp', '3', '4', '10.0.0.0/8'), ('icmp', 3, 4, '10.0.0.0/8')),
+    (('50', None, None, '10.0.0.0/8'), ('50', None, None, '10.0.0.0/8')),
+    (('udp', 53, 53, '2001:db8::/32'), ('udp', 53, 53, '2001:db8::/32')),
+])
+def test_rule_key(args, key):
+    assert cli.rule_key(*args) == key
+
+
+def test_read_rules(tmp_path):
+    path = write_rules(tmp_path, '''
+        # comment
+        tcp 22 10.0.0.0/8
+        tcp 8000-8080 10.0.0.0/8   # range
+        all - 192.168.0.0/24
+        icmp 10.0.0.0/8
+        icmp - 10.1.0.0/16
+        icmp 8 10.2.0.0/16
+        icmpv6 3/0 2001:db8::/32
+    ''')
+
+    assert cli.read_rules(path) == {
+        ('tcp', 22, 22, '10.0.0.0/8'),
+        ('tcp', 8000, 8080, '10.0.0.0/8'),
+        ('-1', None, None, '192.168.0.0/24'),
+        ('icmp', -1, -1, '10.0.0.0/8'),
+        ('icmp', -1, -1, '10.1.0.0/16'),
+        ('icmp', 8, -1, '10.2.0.0/16'),
+        ('icmpv6', 3, 0, '2001:db8::/32'),
+    }
+
+
+@pytest.mark.parametrize('line', ['tcp 10.0.0.0/8', 'tcp x 10.0.0.0/8',
+                                  'icmp 8/x 10.0.0.0/8', 'tcp 22 nowhere',
+                                  'tcp 22 10.0.0.0/8 extra'])
+def test_read_rules_rejects_malformed_lines(tmp_path, line):
+    path = write_rules(tmp_path, f'tcp 22 10.0.0.0/8\n{line}\n')
+
+    with pytest.raises(ValueError, match=r'rules.txt:2:'):
+        cli.read_rules(path)
+
+
+def test_ingress_rules_match_rules_file(tmp_path):
+    """Rules read back from EC2 compare equal to the file's, so the diff
+    of an applied rules file is empty"""
+    path = write_rules(tmp_path, '''
+        tcp 22 10.0.0.0/8
+        all - 192.168.0.0/24
+        icmp 10.0.0.0/8
+        icmp 8 10.2.0.0/16
+    ''')
+    permissions = [
+        permission('tcp', 22, 22, '10.0.0.0/8'),
+        permission('-1', None, None, '192.168.0.0/24'),
+        permission('icmp', -1, -1, '10.0.0.0/8'),
+        permission('icmp', 8, -1, '10.2.0.0/16'),
+    ]
+
+    assert cli.ingress_rules(permissions) == cli.read_rules(path)
+
+
+def test_ip_permissions_round_trip():
+    rules = {
+        ('tcp', 22, 22, '10.0.0.0/8'),
+        ('tcp', 22, 22, '2001:db8::/32'),
+        ('-1', None, None, '192.168.0.0/24'),
+        ('icmp', -1, -1, '10.0.0.0/8'),
+        ('50', None, None, '10.0.0.0/8'),
+    }
+
+    permissions = cli.ip_permissions(rules)
+
+    assert cli.ingress_rules(permissions) == rules
+    all_traffic, = [p for p in permissions if p['IpProtocol'] == '-1']
+    assert 'FromPort' not in all_traffic
+    tcp, = [p for p in permissions if p['IpProtocol'] == 'tcp']
+    assert tcp['IpRanges'] == [{'CidrIp': '10.0.0.0/8'}]
+    assert tcp['Ipv6Ranges'] == [{'CidrIpv6': '2001:db8::/32'}]
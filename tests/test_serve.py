@@ -0,0 +1,51 @@
+import socket
+import threading
+
+import pytest
+
+import cli
+
+
+@pytest.fixture
+def writer():
+    daemon_end, client_end = socket.socketpair()
+    wfile = daemon_end.makefile('wb', buffering=0)
+    yield cli._FrameWriter(daemon_end, wfile, 'stdout',
+                           threading.Lock()), client_end
+    wfile.close()
+    daemon_end.close()
+    client_end.close()
+
+
+def test_output_is_sent_as_frames(writer):
+    frames, client_end = writer
+
+    print('hello', file=frames, flush=True)
+
+    assert client_end.recv(100) == b'{"stdout": "hello"}\n{"stdout": "\\n"}\n'
+
+
+def test_writing_to_a_closed_client_stops_the_command(writer):
+    frames, client_end = writer
+    client_end.close()
+
+    with pytest.raises(cli.ClientGone):
+        frames.write('x' * 1000000)
+
+
+def test_flushing_notices_a_closed_client(writer):
+    frames, client_end = writer
+    frames.flush()
+
+    client_end.close()
+
+    with pytest.raises(cli.ClientGone):
+        frames.flush()
+
+
+def test_watch_needs_a_count_in_the_daemon(capsys):
+    with pytest.raises(SystemExit) as e:
+        cli.main(['watch'], serving=True)
+
+    assert e.value.code == 2
+    assert '--count is needed' in capsys.readouterr().err
@@ -0,0 +1,110 @@
+from types import SimpleNamespace
+
+import pytest
+
+import cli
+
+REGION = 'ap-southeast-2'
+SESSION = SimpleNamespace(profile_name='demo', region_name=REGION)
+TAGS = [
+    {'ResourceType': 'vpc', 'ResourceId': 'vpc-1', 'Value': 'demo'},
+    {'ResourceType': 'subnet', 'ResourceId': 'subnet-1',
+     'Value': 'demo-az-a'},
+    {'ResourceType': 'route-table', 'ResourceId': 'rtb-1',
+     'Value': 'demo-public'},
+    {'ResourceType': 'security-group', 'ResourceId': 'sg-1',
+     'Value': 'demo'},
+]
+
+
+@pytest.fixture
+def index(monkeypatch):
+    monkeypatch.setattr(cli, '_tag_indexes', {})
+    monkeypatch.setattr(cli, 'paginate', lambda *args, **kwargs: iter(TAGS))
+    return cli.tag_index(SESSION, 'demo')
+
+
+def after_call(operation, params, parsed=None):
+    cli._update_tag_indexes(SimpleNamespace(name=operation),
+                            {'client_region': REGION, 'params': params},
+                            parsed=parsed or {})
+
+
+@pytest.mark.parametrize('operation, params', [
+    ('DeleteRoute', {'RouteTableId': 'rtb-1',
+                     'DestinationCidrBlock': '0.0.0.0/0'}),
+    ('DisassociateRouteTable', {'AssociationId': 'rtbassoc-1'}),
+    ('DeleteNetworkAcl', {'NetworkAclId': 'acl-1'}),
+    ('DeleteNetworkInterface', {'NetworkInterfaceId': 'eni-1'}),
+    ('DeleteTags', {'Resources': ['vpc-1'],
+                    'Tags': [{'Key': 'Owner'}]}),
+])
+def test_other_deletes_keep_the_resources(index, operation, params):
+    after_call(operation, params)
+
+    assert index.get_id('route-table', 'demo-public') == 'rtb-1'
+    assert index.get_id('vpc', 'demo') == 'vpc-1'
+
+
+@pytest.mark.parametrize('operation, params, resource_type, name', [
+    ('DeleteVpc', {'VpcId': 'vpc-1'}, 'vpc', 'demo'),
+    ('DeleteSubnet', {'SubnetId': 'subnet-1'}, 'subnet', 'demo-az-a'),
+    ('DeleteRouteTable', {'RouteTableId': 'rtb-1'}, 'route-table',
+     'demo-public'),
+    ('DeleteSecurityGroup', {'GroupId': 'sg-1'}, 'security-group', 'demo'),
+])
+def test_deleting_a_resource_removes_it(index, operation, params,
+                                        resource_type, name):
+    after_call(operation, params)
+
+    assert index.get_id(resource_type, name) is None
+
+
+def test_failed_delete_keeps_the_resource(index):
+    after_call('DeleteVpc', {'VpcId': 'vpc-1'},
+               {'Error': {'Code': 'DependencyViolation'}})
+
+    assert index.get_id('vpc', 'demo') == 'vpc-1'
+
+
+def test_creates_and_renames_are_indexed(index):
+    after_call('CreateSubnet',
+               {'VpcId': 'vpc-1', 'TagSpecifications': [{
+                   'ResourceType': 'subnet',
+                   'Tags': [{'Key': 'Name', 'Value': 'demo-az-b'}]}]},
+               {'Subnet': {'SubnetId': 'subnet-2', 'VpcId': 'vpc-1'}})
+    after_call('CreateTags', {'Resources': ['subnet-1'],
+                              'Tags': [{'Key': 'Name',
+                                        'Value': 'demo-az-c'}]})
+
+    assert index.get_id('subnet', 'demo-az-b') == 'subnet-2'
+    assert index.get_id('subnet', 'demo-az-a') is None
+    assert index.get_id('subnet', 'demo-az-c') == 'subnet-1'
+
+
+@pytest.fixture
+def state(monkeypatch, tmp_path):
+    state = cli.StateStore(tmp_path / 'state.json')
+    monkeypatch.setattr(cli, 'get_state', lambda: state)
+    return state
+
+
+def test_resource_id_prefers_the_state_id_the_index_has(index, state):
+    index.add('vpc', 'demo', 'vpc-2')
+    state.put('vpc', 'demo', 'vpc-2')
+
+    assert cli.resource_id(SESSION, 'vpc', 'demo') == 'vpc-2'
+
+
+def test_resource_id_drops_a_state_id_deleted_elsewhere(index, state):
+    state.put('route-table', 'demo-public', 'rtb-9')
+
+    assert cli.resource_id(SESSION, 'route-table', 'demo-public',
+                           'demo') == 'rtb-1'
+    assert state.get_id('route-table', 'demo-public') is None
+
+
+def test_resource_id_is_none_without_the_resource(index, state):
+    state.put('internet-gateway', 'demo', 'igw-9')
+
+    assert cli.resource_id(SESSION, 'internet-gateway', 'demo') is None
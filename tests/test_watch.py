@@ -0,0 +1,27 @@
+from types import SimpleNamespace
+
+import cli
+
+
+def test_recorded_drift_ignores_sibling_stacks(tmp_path, monkeypatch):
+    state = cli.StateStore(tmp_path / 'state.json')
+    state.put_many([
+        ('vpc', 'demo', 'vpc-1', None),
+        ('subnet', 'demo-az-a', 'subnet-1', None),
+        ('subnet', 'demo-az-b', 'subnet-2', None),
+        ('vpc', 'demo2', 'vpc-2', None),
+        ('subnet', 'demo2-az-a', 'subnet-3', None),
+    ])
+    monkeypatch.setattr(cli, 'get_state', lambda: state)
+    watcher = cli.StackWatcher(SimpleNamespace(region_name='region'), 'demo')
+    snapshot = {
+        ('vpc', 'vpc-1'): ('hash', {'Tags': [{'Key': 'Name',
+                                              'Value': 'demo'}]}),
+        ('subnet', 'subnet-1'): ('hash', {'Tags': [{'Key': 'Name',
+                                                    'Value': 'other'}]}),
+    }
+
+    assert watcher.recorded_drift(snapshot) == {
+        ('subnet', 'demo-az-a'): ('subnet-1', 'renamed'),
+        ('subnet', 'demo-az-b'): ('subnet-2', 'missing'),
+    }